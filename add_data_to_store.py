@@ -2,6 +2,7 @@ import json
 import argparse
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import redis
 import requests
@@ -10,10 +11,135 @@ from environs import Env
 from moltin_api import (get_access_token, set_price_for_product,
                         create_corrency, create_price_book, create_product,
                         upload_image, create_image_relationship, create_flow,
-                        create_field, create_entries_for_flow)
+                        create_field, create_entries_for_flow, get_flows,
+                        get_flow_fields, update_field)
 
 logger = logging.getLogger(__name__)
 
+FIELDS_FOLDER = 'Fields for flow'
+SYNC_WORKERS = 8
+UPDATABLE_FIELD_ATTRIBUTES = ('name', 'description', 'required', 'enabled',
+                              'order', 'omit_null')
+# describe the field in the json but are not compared with the store
+FIELD_SERVICE_ATTRIBUTES = ('type', 'slug', 'relationships')
+
+
+def load_flow_schemas(folder: str) -> dict:
+    '''Reads every `<flow_slug>_fields.json` file of the folder.'''
+    schemas = {}
+    for filename in sorted(os.listdir(folder)):
+        if filename.endswith('_fields.json'):
+            flow_slug = filename.removesuffix('_fields.json')
+            schemas[flow_slug] = load_flow_fields(os.path.join(folder,
+                                                               filename))
+    return schemas
+
+
+def load_flow_fields(path: str) -> list:
+    with open(path, 'r') as f:
+        return [field['data'] for field in json.load(f)]
+
+
+def plan_flow_sync(store_access_token: str, schemas: dict,
+                   executor: ThreadPoolExecutor) -> dict:
+    '''Compares flows and fields by slug with the ones in the store.'''
+    flow_ids = {flow['slug']: flow['id']
+                for flow in get_flows(store_access_token)}
+    existing_slugs = [slug for slug in schemas if slug in flow_ids]
+    existing_fields = dict(zip(existing_slugs, executor.map(
+        lambda slug: get_flow_fields(store_access_token, slug),
+        existing_slugs
+    )))
+    plan = {
+        'flow_ids': flow_ids,
+        'flows_to_create': [slug for slug in schemas if slug not in flow_ids],
+        'fields_to_create': [],
+        'fields_to_update': [],
+        'fields_with_drift': [],
+    }
+    for flow_slug, fields in schemas.items():
+        current_fields = {field['slug']: field
+                          for field in existing_fields.get(flow_slug, [])}
+        for field in fields:
+            current_field = current_fields.get(field['slug'])
+            if not current_field:
+                plan['fields_to_create'].append((flow_slug, field))
+                continue
+            changes = {
+                attribute: field[attribute]
+                for attribute in UPDATABLE_FIELD_ATTRIBUTES
+                if attribute in field
+                and current_field.get(attribute) != field[attribute]
+            }
+            if changes:
+                plan['fields_to_update'].append(
+                    (flow_slug, current_field['id'], field['slug'], changes)
+                )
+            drift = {
+                attribute: (current_field.get(attribute), value)
+                for attribute, value in field.items()
+                if attribute not in UPDATABLE_FIELD_ATTRIBUTES
+                and attribute not in FIELD_SERVICE_ATTRIBUTES
+                and current_field.get(attribute) != value
+            }
+            if drift:
+                plan['fields_with_drift'].append(
+                    (flow_slug, field['slug'], drift))
+    return plan
+
+
+def print_flow_sync_plan(plan: dict) -> None:
+    for flow_slug in plan['flows_to_create']:
+        print('Создать flow:', flow_slug)
+    for flow_slug, field in plan['fields_to_create']:
+        print(f'Создать поле: {flow_slug}.{field["slug"]}')
+    for flow_slug, _, field_slug, changes in plan['fields_to_update']:
+        print(f'Обновить поле: {flow_slug}.{field_slug}', changes)
+    for flow_slug, field_slug, drift in plan['fields_with_drift']:
+        print(f'Поле {flow_slug}.{field_slug} нельзя обновить, пересоздайте '
+              'его вручную (в магазине, в описании):', drift)
+
+
+def apply_flow_sync(store_access_token: str, plan: dict,
+                    executor: ThreadPoolExecutor) -> None:
+    flow_ids = dict(plan['flow_ids'])
+    created_flows = executor.map(
+        lambda slug: create_flow(store_access_token, slug.replace('_', ' ')),
+        plan['flows_to_create']
+    )
+    flow_ids.update(zip(plan['flows_to_create'], created_flows))
+    futures = [
+        executor.submit(create_field, store_access_token, {'data': field},
+                        flow_ids[flow_slug])
+        for flow_slug, field in plan['fields_to_create']
+    ]
+    futures += [
+        executor.submit(update_field, store_access_token, field_id, changes)
+        for _, field_id, _, changes in plan['fields_to_update']
+    ]
+    for future in futures:
+        future.result()
+
+
+def sync_flows(store_access_token: str, schemas: dict,
+               check: bool = False) -> bool:
+    '''Brings flows to the schemas, returns whether they differed.'''
+    with ThreadPoolExecutor(max_workers=SYNC_WORKERS) as executor:
+        plan = plan_flow_sync(store_access_token, schemas, executor)
+        has_changes = any((plan['flows_to_create'], plan['fields_to_create'],
+                           plan['fields_to_update'],
+                           plan['fields_with_drift']))
+        if not has_changes:
+            print('Flow и поля совпадают с описанием')
+            return False
+        print_flow_sync_plan(plan)
+        if not check:
+            apply_flow_sync(store_access_token, plan, executor)
+            print('Flow и поля обновлены')
+            if plan['fields_with_drift']:
+                print('Часть полей осталась отличной от описания')
+    return True
+
 
 def main():
     env = Env()
@@ -25,7 +151,6 @@ def main():
     client_id = env.str('ELASTICPATH_CLIENT_ID')
     token_lifetime = env.int('TOKEN_LIFETIME')
     price_book_id = env.str('PRICE_BOOK_ID', '')
-    flow_id = env.str('FLOW_ID', '')
     parser = argparse.ArgumentParser(
         description=''
     )
@@ -36,6 +161,12 @@ def main():
     parser.add_argument('--fields', default='', type=str,
                         help='''Аргумент для создания полей для моделей
                                 и путь до файла с данными о полях''')
+    parser.add_argument('--sync_flows', action=argparse.BooleanOptionalAction,
+                        help='''Аргумент для приведения всех flow и полей
+                                к файлам из папки Fields for flow''')
+    parser.add_argument('--check', action=argparse.BooleanOptionalAction,
+                        help='''Только показать отличия flow от описания,
+                                код выхода 1 при наличии отличий''')
     parser.add_argument('--menu', action=argparse.BooleanOptionalAction,
                         help='Аргумент для добавления товаров в магазин')
     parser.add_argument('--address', action=argparse.BooleanOptionalAction,
@@ -55,20 +186,24 @@ def main():
                         store_access_token)
     else:
         store_access_token = store_access_token.decode('utf-8')
+    exit_code = 0
     try:
         if args.price_book:
             create_corrency(store_access_token)
             price_book_id = create_price_book(store_access_token)
             print('price_book_id:', price_book_id)
         elif args.flow and args.fields:
-            flow_id = create_flow(store_access_token, args.flow)
-            print('flow_id:', flow_id)
-            folder_with_fields = 'Fields for flow'
-            with open(os.path.join(folder_with_fields, args.fields), 'r') as f:
-                fields_for_flow = json.load(f)
-            for field in fields_for_flow:
-                create_field(store_access_token, field, flow_id)
-            print('Поля для Flow созданы')
+            flow_slug = args.flow.replace(' ', '_')
+            fields = load_flow_fields(os.path.join(FIELDS_FOLDER,
+                                                   args.fields))
+            if sync_flows(store_access_token, {flow_slug: fields},
+                          args.check) and args.check:
+                exit_code = 1
+        elif args.sync_flows:
+            schemas = load_flow_schemas(FIELDS_FOLDER)
+            if sync_flows(store_access_token, schemas, args.check) \
+                    and args.check:
+                exit_code = 1
         elif args.address:
             url = 'https://dvmn.org/media/filer_public/90/90/9090ecbf-249f-42c7-8635-a96985268b88/addresses.json'
             response = requests.get(url)
@@ -94,10 +229,12 @@ def main():
             print('Вы не указали аргумент')
     except FileNotFoundError as error:
         logger.warning(error)
-    except requests.exceptions.HTTPError as error:
+        exit_code = 1
+    except requests.exceptions.RequestException as error:
         logger.warning(error)
+        exit_code = 1
     finally:
-        exit(0)
+        exit(exit_code)
 
 
 if __name__ == '__main__':
@@ -1,4 +1,8 @@
+import json
 import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from math import ceil
 from textwrap import dedent
 
@@ -7,27 +11,50 @@ import requests
 from geopy import distance
 from environs import Env
 from telegram import (ParseMode, LabeledPrice, Update,
-                      InlineKeyboardButton, InlineKeyboardMarkup)
+                      InlineKeyboardButton, InlineKeyboardMarkup,
+                      InlineQueryResultArticle, InputTextMessageContent)
+from telegram.error import TelegramError
 from telegram.ext import (Filters, Updater, CallbackContext, CommandHandler,
                           CallbackQueryHandler, MessageHandler,
-                          PreCheckoutQueryHandler)
+                          PreCheckoutQueryHandler, InlineQueryHandler)
 
-from moltin_api import (get_access_token, get_products, get_product_image,
+from moltin_api import (get_access_token, get_products,
+                        get_product_image_link,
                         put_product_in_cart, get_user_cart,
                         delete_cart_product, get_entry_from_flow,
                         get_pizzeria_list, create_entries_for_flow,
-                        delete_all_cart_products)
+                        delete_all_cart_products, set_hedged_reads,
+                        http_session, register_token)
+from card_cache import CardCache
+from dispatch import (DISPATCH_ATTEMPTS, enqueue_delivery,
+                      get_queued_pizzerias, group_orders, pick_courier,
+                      render_batch_message, requeue_orders, take_orders)
+from catalog_search import CatalogIndex
+from profiling import UpdateProfiler, annotate_update
+from resilience import CircuitBreaker, CircuitOpenError
+from sales import get_product_sales, record_order, sort_by_popularity
+from tenants import NamespacedRedis, load_stores
+from traffic import TrafficRecorder
 
 logger = logging.getLogger(__name__)
 
+CART_MUTATION_ATTEMPTS = 3
+# longer than the worst case of put_product_in_cart_once: three reads and
+# three adds hitting the cart timeouts plus the pauses between attempts
+CART_PENDING_TTL = 90
+IMAGE_HANDLE_TTL = 86400
+
+GEOCODER_TIMEOUT = (3.05, 5)
+geocoder_breaker = CircuitBreaker('geocode-maps.yandex.ru')
+
 
 def fetch_coordinates(apikey, address):
     base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
+    response = geocoder_breaker.call(http_session.get, base_url, params={
         "geocode": address,
         "apikey": apikey,
         "format": "json",
-    })
+    }, timeout=GEOCODER_TIMEOUT)
     response.raise_for_status()
     found_places = response.json()['response']['GeoObjectCollection']['featureMember']
 
@@ -54,6 +81,17 @@ def parse_products(raw_products: list) -> dict:
     return products
 
 
+def get_menu_products(bot_data: dict, store_access_token: str) -> dict:
+    '''Returns the catalog with the best selling products first.'''
+    products = parse_products(get_products(store_access_token))
+    card_cache = bot_data['card_cache']
+    product_sales = card_cache.get('product_sales')
+    if product_sales is None:
+        product_sales = get_product_sales(bot_data['_database'])
+        card_cache.set('product_sales', product_sales)
+    return sort_by_popularity(products, product_sales)
+
+
 def get_menu_buttons(products: dict, products_per_page: int,
                      pages_number: int, page: int = 0) -> list:
     keyboard = []
@@ -86,10 +124,57 @@ def get_product_quantity_in_cart(product_id, user_cart) -> int:
     return 0
 
 
+def save_order_snapshot(user_cart: dict, chat_id: int,
+                        _database: redis.Redis, snapshot_ttl: int) -> dict:
+    '''Stores product ids, quantities and amounts in kopecks of the cart.'''
+    snapshot = {
+        'items': [
+            [product.get('product_id'), product.get('quantity'),
+             product.get('meta').get('display_price')
+             .get('without_tax').get('unit').get('amount')]
+            for product in user_cart.get('data')
+        ],
+        'total': user_cart.get('meta').get('display_price')
+        .get('without_tax').get('amount'),
+    }
+    _database.setex(f'{chat_id}_order_snapshot', snapshot_ttl,
+                    json.dumps(snapshot, separators=(',', ':')))
+    return snapshot
+
+
+def has_pending_cart_updates(_database: redis.Redis, chat_id: int) -> bool:
+    '''Checks whether products added optimistically are still on the way.'''
+    return any(int(pending) > 0 for pending
+               in _database.hvals(f'{chat_id}_cart_pending'))
+
+
+def get_order_snapshot(store_access_token: str, chat_id: int,
+                       _database: redis.Redis, snapshot_ttl: int) -> dict:
+    raw_snapshot = _database.get(f'{chat_id}_order_snapshot')
+    if raw_snapshot:
+        return json.loads(raw_snapshot)
+    user_cart = get_user_cart(store_access_token, chat_id)
+    return save_order_snapshot(user_cart, chat_id, _database, snapshot_ttl)
+
+
+def render_order_message(snapshot: dict, products: dict) -> str:
+    message = ''
+    for product_id, quantity, unit_amount in snapshot['items']:
+        product = products.get(product_id) or {}
+        message += dedent(f'''
+        <b>{product.get('name', product_id)}</b>
+        {quantity} шт. × {unit_amount/100:.2f} РУБ = <u>{quantity*unit_amount/100:.2f} РУБ</u>
+        ''')
+    message += dedent(f'''
+    <b>Общая стоимость:</b> <u>{snapshot['total']/100:.2f} РУБ</u>''')
+    return message
+
+
 def prepare_cart_buttons_and_message(
         user_cart: dict,
         chat_id: int,
-        _database: redis.Redis) -> tuple[str, InlineKeyboardMarkup]:
+        _database: redis.Redis,
+        snapshot_ttl: int) -> tuple[str, InlineKeyboardMarkup]:
     products = user_cart.get('data')
     message = ''
     keyboard = []
@@ -117,10 +202,10 @@ def prepare_cart_buttons_and_message(
             .get('without_tax').get('amount')
         message += dedent(f'''
         <b>Общая стоимость:</b> <u>{cart_total_cost/100:.2f} РУБ</u>''')
-        _database.json().set(f'{chat_id}_menu', '$',
-                             {'menu': message, 'price': cart_total_cost/100})
+        save_order_snapshot(user_cart, chat_id, _database, snapshot_ttl)
     else:
         message = 'Ваша корзина пуста'
+        _database.delete(f'{chat_id}_order_snapshot')
 
     keyboard.append([InlineKeyboardButton('В меню', callback_data='В меню')])
     if len(keyboard) > 1:
@@ -159,14 +244,20 @@ def prepare_description_buttons_and_message(
 def start(update: Update, context: CallbackContext) -> str:
     store_access_token = context.bot_data['store_access_token']
     products_per_page = context.bot_data['products_per_page']
-    raw_products = get_products(store_access_token)
-    products = parse_products(raw_products)
+    products = get_menu_products(context.bot_data, store_access_token)
+    _, _, product_id = update.message.text.partition(' ')
+    if product_id in products:
+        chat_id = update.message.chat_id
+        user_cart = get_user_cart(store_access_token, chat_id)
+        return send_product_description(context, chat_id, product_id,
+                                        products[product_id], user_cart)
     pages_number = ceil(len(products) / products_per_page)
     context.bot_data['page_number'] = 0
     keyboard = get_menu_buttons(products, products_per_page, pages_number)
     reply_markup = InlineKeyboardMarkup(keyboard)
     update.message.reply_text(text='Пожалуйста, выберите товар!',
                               reply_markup=reply_markup)
+    prefetch_menu_page(context, update.message.chat_id, products)
     return 'HANDLE_MENU'
 
 
@@ -184,8 +275,7 @@ def handle_menu(update: Update, context: CallbackContext) -> str:
         page_number = page_number + 1 if user_reply == 'forward' \
             else page_number - 1
         products_per_page = context.bot_data['products_per_page']
-        raw_products = get_products(store_access_token)
-        products = parse_products(raw_products)
+        products = get_menu_products(context.bot_data, store_access_token)
 
         pages_number = ceil(len(products) / products_per_page)
         page_number = 0 if page_number >= pages_number else page_number
@@ -199,36 +289,257 @@ def handle_menu(update: Update, context: CallbackContext) -> str:
                          reply_markup=reply_markup)
         bot.delete_message(chat_id=chat_id,
                            message_id=query.message.message_id)
+        prefetch_menu_page(context, chat_id, products, page_number)
         return 'HANDLE_MENU'
-    user_cart = get_user_cart(store_access_token, chat_id)
+    card_cache = context.bot_data['card_cache']
     if user_reply == 'Корзина':
-        message, reply_markup = prepare_cart_buttons_and_message(user_cart,
-                                                                 chat_id,
-                                                                 _database)
+        if has_pending_cart_updates(_database, chat_id):
+            query.answer(text='Корзина ещё обновляется, попробуйте через '
+                              'пару секунд')
+            return 'HANDLE_MENU'
+        user_cart = get_user_cart(store_access_token, chat_id)
+        card_cache.set(('cart', chat_id), user_cart)
+        message, reply_markup = prepare_cart_buttons_and_message(
+            user_cart, chat_id, _database, context.bot_data['snapshot_ttl'])
         bot.send_message(chat_id=chat_id, text=message,
                          reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         bot.delete_message(chat_id=chat_id,
                            message_id=query.message.message_id)
         return 'HANDLE_CART'
-    raw_products = get_products(store_access_token)
-    products = parse_products(raw_products)
-    context.bot_data['product_id'] = user_reply
-    product_data = products.get(user_reply)
-    context.bot_data[f'{user_reply}_data'] = product_data
+    user_cart = card_cache.get(('cart', chat_id)) \
+        or get_user_cart(store_access_token, chat_id)
+    products = card_cache.get('products') \
+        or parse_products(get_products(store_access_token))
+    next_state = send_product_description(context, chat_id, user_reply,
+                                          products.get(user_reply), user_cart)
+    bot.delete_message(chat_id=chat_id,
+                       message_id=query.message.message_id)
+    return next_state
+
+
+def send_product_description(context: CallbackContext, chat_id: int,
+                             product_id: str, product_data: dict,
+                             user_cart: dict) -> str:
+    store_access_token = context.bot_data['store_access_token']
+    context.bot_data['product_id'] = product_id
+    context.bot_data[f'{product_id}_data'] = product_data
+
+    quantity_in_cart = get_product_quantity_in_cart(product_id, user_cart)
+    if context.bot_data['optimistic_cart']:
+        quantity_in_cart = sync_local_quantity(context.bot_data, chat_id,
+                                               product_id, quantity_in_cart)
+    send_product_card(context.bot, context.bot_data, store_access_token,
+                      chat_id, product_id, product_data, quantity_in_cart)
+    return 'HANDLE_DESCRIPTION'
+
 
+def get_image_handle(bot_data: dict, store_access_token: str,
+                     image_id: str) -> str:
+    '''Returns a Telegram file_id of the image or a link to download it.'''
+    card_cache = bot_data['card_cache']
+    image_handle = card_cache.get(('image', image_id))
+    if not image_handle:
+        image_handle = get_product_image_link(store_access_token, image_id)
+        card_cache.set(('image', image_id), image_handle,
+                       ttl=IMAGE_HANDLE_TTL)
+    return image_handle
+
+
+def get_description_card(card_cache: CardCache, product_id: str,
+                         product_data: dict,
+                         quantity_in_cart: int) -> tuple[str, InlineKeyboardMarkup]:
+    card = card_cache.get(('card', product_id, quantity_in_cart))
+    if not card:
+        card = prepare_description_buttons_and_message(product_data,
+                                                       quantity_in_cart)
+        card_cache.set(('card', product_id, quantity_in_cart), card)
+    return card
+
+
+def send_product_card(bot, bot_data: dict, store_access_token: str,
+                      chat_id: int, product_id: str, product_data: dict,
+                      quantity_in_cart: int) -> None:
+    card_cache = bot_data['card_cache']
     image_id = product_data.get('image_id')
-    image = get_product_image(store_access_token, image_id)
-    quantity_in_cart = get_product_quantity_in_cart(user_reply, user_cart)
+    image = get_image_handle(bot_data, store_access_token, image_id)
+    message, reply_markup = get_description_card(card_cache, product_id,
+                                                 product_data,
+                                                 quantity_in_cart)
+    sent_message = bot.send_photo(chat_id=chat_id, photo=image,
+                                  caption=message, reply_markup=reply_markup,
+                                  parse_mode=ParseMode.HTML)
+    card_cache.set(('image', image_id), sent_message.photo[-1].file_id,
+                   ttl=IMAGE_HANDLE_TTL)
+
+
+def prefetch_menu_page(context: CallbackContext, chat_id: int,
+                       products: dict, page_number: int = 0) -> None:
+    '''Warms product cards of the shown menu page in the background.'''
+    if not context.bot_data['prefetch_cards']:
+        return
+    products_per_page = context.bot_data['products_per_page']
+    pages_number = ceil(len(products) / products_per_page)
+    pages = [page_number]
+    if context.bot_data['prefetch_adjacent_page'] and pages_number > 1:
+        pages.append((page_number + 1) % pages_number)
+    product_ids = list(products)
+    page_products = {
+        product_id: products[product_id]
+        for page in pages
+        for product_id in product_ids[page * products_per_page:
+                                      (page + 1) * products_per_page]
+    }
+    context.bot_data['card_cache'].set('products', products)
+    run_in_background(
+        context.bot_data, warm_product_cards, context.bot_data,
+        context.bot_data['store_access_token'], chat_id, page_products
+    )
+
+
+def warm_product_cards(bot_data: dict, store_access_token: str,
+                       chat_id: int, products: dict) -> None:
+    card_cache = bot_data['card_cache']
+    try:
+        user_cart = get_user_cart(store_access_token, chat_id)
+        card_cache.set(('cart', chat_id), user_cart)
+        for product_id, product_data in products.items():
+            get_image_handle(bot_data, store_access_token,
+                             product_data.get('image_id'))
+            quantity_in_cart = get_product_quantity_in_cart(product_id,
+                                                            user_cart)
+            get_description_card(card_cache, product_id, product_data,
+                                 quantity_in_cart)
+    except requests.exceptions.RequestException as err:
+        logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
+
+
+def sync_local_quantity(bot_data: dict, chat_id: int, product_id: str,
+                        quantity_in_cart: int) -> int:
+    '''Saves the quantity from Moltin unless cart updates are in progress.'''
+    _database = bot_data['_database']
+    if int(_database.hget(f'{chat_id}_cart_pending', product_id) or 0) > 0:
+        return int(_database.hget(f'{chat_id}_cart_quantities', product_id)
+                   or quantity_in_cart)
+    with _database.pipeline() as pipe:
+        pipe.hset(f'{chat_id}_cart_quantities', product_id, quantity_in_cart)
+        pipe.expire(f'{chat_id}_cart_quantities', bot_data['snapshot_ttl'])
+        pipe.execute()
+    return quantity_in_cart
+
+
+def edit_description_caption(bot, chat_id: int, message_id: int,
+                             product_data: dict, quantity_in_cart: int) -> None:
     message, reply_markup = prepare_description_buttons_and_message(
         product_data, quantity_in_cart)
+    try:
+        bot.edit_message_caption(chat_id=chat_id, message_id=message_id,
+                                 caption=message, reply_markup=reply_markup,
+                                 parse_mode=ParseMode.HTML)
+    except TelegramError as err:
+        logger.info(f'Не удалось обновить карточку товара\n{err}\n')
 
-    bot.send_photo(chat_id=chat_id, photo=image, caption=message,
-                   reply_markup=reply_markup, parse_mode=ParseMode.HTML)
-    bot.delete_message(chat_id=chat_id,
-                       message_id=query.message.message_id)
+
+def add_product_optimistically(query, context: CallbackContext,
+                               product_id: str, product_data: dict,
+                               quantity: int) -> str:
+    '''Shows the new quantity at once and updates the Moltin cart later.'''
+    _database = context.bot_data['_database']
+    chat_id = query.message.chat_id
+    with _database.pipeline() as pipe:
+        pipe.hincrby(f'{chat_id}_cart_quantities', product_id, quantity)
+        pipe.hincrby(f'{chat_id}_cart_pending', product_id, 1)
+        pipe.expire(f'{chat_id}_cart_quantities',
+                    context.bot_data['snapshot_ttl'])
+        # a crashed add must not keep the cart locked for long
+        pipe.expire(f'{chat_id}_cart_pending', CART_PENDING_TTL)
+        quantity_in_cart, *_ = pipe.execute()
+    query.answer(text='Товар добавлен к корзину')
+    edit_description_caption(context.bot, chat_id, query.message.message_id,
+                             product_data, quantity_in_cart)
+    run_in_background(
+        context.bot_data, put_product_in_cart_in_background, context,
+        context.bot_data['store_access_token'], chat_id,
+        query.message.message_id, product_id, product_data, quantity
+    )
     return 'HANDLE_DESCRIPTION'
 
 
+def put_product_in_cart_once(store_access_token: str, product_id: str,
+                             quantity: int, chat_id: int) -> dict | None:
+    '''Adds the product to the Moltin cart without adding it twice.
+
+    Adding is not idempotent, so it is repeated at once only when the request
+    surely did not reach Moltin. After a timeout or a 5xx the cart is read
+    again and the add is repeated only if it was not applied.
+    '''
+    try:
+        quantity_before = get_product_quantity_in_cart(
+            product_id, get_user_cart(store_access_token, chat_id))
+    except requests.exceptions.RequestException as err:
+        logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
+        quantity_before = None
+    must_check_cart = False
+    for attempt in range(CART_MUTATION_ATTEMPTS):
+        try:
+            if must_check_cart:
+                if quantity_before is None:
+                    return None
+                user_cart = get_user_cart(store_access_token, chat_id)
+                quantity_in_cart = get_product_quantity_in_cart(product_id,
+                                                                user_cart)
+                if quantity_in_cart >= quantity_before + quantity:
+                    return user_cart
+            return put_product_in_cart(store_access_token, product_id,
+                                       quantity, chat_id)
+        except (requests.exceptions.ConnectTimeout, CircuitOpenError) as err:
+            logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
+        except requests.exceptions.RequestException as err:
+            logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
+            response = getattr(err, 'response', None)
+            if response is not None and response.status_code < 500:
+                return None
+            must_check_cart = True
+        if attempt + 1 < CART_MUTATION_ATTEMPTS:
+            time.sleep(2 ** attempt)
+    return None
+
+
+def put_product_in_cart_in_background(context: CallbackContext,
+                                      store_access_token: str, chat_id: int,
+                                      message_id: int, product_id: str,
+                                      product_data: dict,
+                                      quantity: int) -> None:
+    _database = context.bot_data['_database']
+    try:
+        user_cart = put_product_in_cart_once(store_access_token, product_id,
+                                             quantity, chat_id)
+    finally:
+        pending = _database.hincrby(f'{chat_id}_cart_pending', product_id,
+                                    -1)
+    quantities_key = f'{chat_id}_cart_quantities'
+    if not user_cart:
+        quantity_in_cart = _database.hincrby(quantities_key, product_id,
+                                             -quantity)
+        context.bot.send_message(
+            chat_id,
+            text=f'Не удалось добавить {product_data.get("name")} в корзину, '
+                 'попробуйте ещё раз'
+        )
+        edit_description_caption(context.bot, chat_id, message_id,
+                                 product_data, quantity_in_cart)
+        return
+    context.bot_data['card_cache'].set(('cart', chat_id), user_cart)
+    if pending > 0:
+        return
+    quantity_in_cart = get_product_quantity_in_cart(product_id, user_cart)
+    local_quantity = int(_database.hget(quantities_key, product_id) or 0)
+    if quantity_in_cart == local_quantity:
+        return
+    _database.hset(quantities_key, product_id, quantity_in_cart)
+    edit_description_caption(context.bot, chat_id, message_id, product_data,
+                             quantity_in_cart)
+
+
 def handle_description(update: Update, context: CallbackContext) -> str:
     _database = context.bot_data['_database']
     bot = context.bot
@@ -242,34 +553,36 @@ def handle_description(update: Update, context: CallbackContext) -> str:
         product_id = context.bot_data['product_id']
         product_data = context.bot_data[f'{product_id}_data']
         quantity = 1
+        if context.bot_data['optimistic_cart']:
+            return add_product_optimistically(query, context, product_id,
+                                              product_data, quantity)
         user_cart = put_product_in_cart(store_access_token, product_id,
                                         quantity, chat_id)
+        context.bot_data['card_cache'].set(('cart', chat_id), user_cart)
         bot.answer_callback_query(text='Товар добавлен к корзину',
                                   callback_query_id=query.id,)
 
         quantity_in_cart = get_product_quantity_in_cart(product_id, user_cart)
-        message, reply_markup = prepare_description_buttons_and_message(
-            product_data, quantity_in_cart)
-        image_id = product_data.get('image_id')
-        image = get_product_image(store_access_token, image_id)
-        bot.send_photo(chat_id=chat_id, photo=image, caption=message,
-                       reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+        send_product_card(bot, context.bot_data, store_access_token, chat_id,
+                          product_id, product_data, quantity_in_cart)
         bot.delete_message(chat_id=chat_id,
                            message_id=query.message.message_id)
         return 'HANDLE_DESCRIPTION'
     elif user_reply == 'Корзина':
+        if has_pending_cart_updates(_database, chat_id):
+            query.answer(text='Корзина ещё обновляется, попробуйте через '
+                              'пару секунд')
+            return 'HANDLE_DESCRIPTION'
         user_cart = get_user_cart(store_access_token, chat_id)
-        message, reply_markup = prepare_cart_buttons_and_message(user_cart,
-                                                                 chat_id,
-                                                                 _database)
+        message, reply_markup = prepare_cart_buttons_and_message(
+            user_cart, chat_id, _database, context.bot_data['snapshot_ttl'])
         bot.send_message(chat_id=chat_id, text=message,
                          reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         bot.delete_message(chat_id=chat_id,
                            message_id=query.message.message_id)
         return 'HANDLE_CART'
     else:
-        raw_products = get_products(store_access_token)
-        products = parse_products(raw_products)
+        products = get_menu_products(context.bot_data, store_access_token)
         products_per_page = context.bot_data['products_per_page']
         pages_number = ceil(len(products) / products_per_page)
         context.bot_data['page_number'] = 0
@@ -280,6 +593,7 @@ def handle_description(update: Update, context: CallbackContext) -> str:
                          reply_markup=reply_markup)
         bot.delete_message(chat_id=chat_id,
                            message_id=query.message.message_id)
+        prefetch_menu_page(context, chat_id, products)
         return 'HANDLE_MENU'
 
 
@@ -296,17 +610,16 @@ def handle_cart(update: Update, context: CallbackContext) -> str:
         product_id = user_reply[4::]
         delete_cart_product(store_access_token, chat_id, product_id)
         user_cart = get_user_cart(store_access_token, chat_id)
-        message, reply_markup = prepare_cart_buttons_and_message(user_cart,
-                                                                 chat_id,
-                                                                 _database)
+        context.bot_data['card_cache'].set(('cart', chat_id), user_cart)
+        message, reply_markup = prepare_cart_buttons_and_message(
+            user_cart, chat_id, _database, context.bot_data['snapshot_ttl'])
         bot.send_message(chat_id=chat_id, text=message,
                          reply_markup=reply_markup, parse_mode=ParseMode.HTML)
         bot.delete_message(chat_id=chat_id,
                            message_id=query.message.message_id)
         return 'HANDLE_CART'
     elif user_reply == 'В меню':
-        raw_products = get_products(store_access_token)
-        products = parse_products(raw_products)
+        products = get_menu_products(context.bot_data, store_access_token)
         products_per_page = context.bot_data['products_per_page']
         pages_number = ceil(len(products) / products_per_page)
         context.bot_data['page_number'] = 0
@@ -317,6 +630,7 @@ def handle_cart(update: Update, context: CallbackContext) -> str:
                          reply_markup=reply_markup)
         bot.delete_message(chat_id=chat_id,
                            message_id=query.message.message_id)
+        prefetch_menu_page(context, chat_id, products)
         return 'HANDLE_MENU'
     else:
         message = 'Пришлите, пожалуйста, ваш адрес текстом или геолокацию'
@@ -340,10 +654,14 @@ def handle_waiting(update: Update, context: CallbackContext) -> str:
         update.message.reply_text(text=message)
         return 'HANDLE_WAITING'
 
-    customer_address_id = create_entries_for_flow(store_access_token,
-                                                  current_pos,
-                                                  flow='customer_address')
     raw_addresses = get_pizzeria_list(store_access_token)
+    try:
+        customer_address_id = create_entries_for_flow(
+            store_access_token, current_pos, flow='customer_address')
+    except requests.exceptions.RequestException as err:
+        # the order keeps the coordinates, the saved address is optional
+        logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
+        customer_address_id = ''
     path_to_pizzerias = {}
     for raw_address in raw_addresses['data']:
         pizzeria_coord = (raw_address['latitude'], raw_address['longitude'])
@@ -353,7 +671,8 @@ def handle_waiting(update: Update, context: CallbackContext) -> str:
                                                raw_address['id'])
     nearest_pizzeria = min(path_to_pizzerias.items(), key=lambda x: x[0])
     _database.set(f'{chat_id}_order',
-                  f'{customer_address_id}${nearest_pizzeria[1][1]}')
+                  f'{customer_address_id}${nearest_pizzeria[1][1]}'
+                  f'${current_pos[0]}${current_pos[1]}')
 
     keyboard = [[InlineKeyboardButton('Доставка', callback_data='Доставка')],
                 [InlineKeyboardButton('Самовывоз', callback_data='Самовывоз')]]
@@ -403,7 +722,7 @@ def handle_delivery(update: Update, context: CallbackContext) -> str:
     query = update.callback_query
     chat_id = query.message.chat_id
     entry_ids = _database.get(f'{chat_id}_order').decode('utf-8')
-    customer_address_id, pizzeria_id = entry_ids.split('$')
+    _, pizzeria_id, *_ = entry_ids.split('$')
     raw_entry = get_entry_from_flow(store_access_token, 'pizzeria',
                                     pizzeria_id)
     pizzeria_coords = (raw_entry['data']['latitude'],
@@ -415,9 +734,11 @@ def handle_delivery(update: Update, context: CallbackContext) -> str:
     reply_markup = InlineKeyboardMarkup(keyboard)
 
     if query.data == 'Доставка':
-        deliveryman_id = raw_entry['data']['deliveryman_id']
-        context.bot_data[f'{chat_id}_delivery'] = \
-            f'{customer_address_id}${deliveryman_id}'
+        couriers = str(raw_entry['data']['deliveryman_id']).split(',')
+        context.bot_data[f'{chat_id}_delivery'] = {
+            'couriers': [courier.strip() for courier in couriers],
+            'pizzeria': pizzeria_coords,
+        }
         message = 'Оплатите пиццу и ожидайте доставщика пиццы'
         bot.send_message(chat_id, text=message, reply_markup=reply_markup)
 
@@ -443,31 +764,91 @@ def handle_payment_choice(update: Update, context: CallbackContext) -> None:
             message = 'Благодарим за заказ!'
             bot.send_message(text=message, chat_id=query.message.chat_id)
 
+        snapshot = get_order_snapshot(store_access_token, chat_id, _database,
+                                      context.bot_data['snapshot_ttl'])
+        entry_ids = _database.get(f'{chat_id}_order').decode('utf-8')
+        customer_address_id, pizzeria_id, *customer_coords = \
+            entry_ids.split('$')
+        if query.data == 'card':
+            # counted in successful_payment_callback once it is paid
+            _database.setex(f'{chat_id}_unpaid_order',
+                            context.bot_data['snapshot_ttl'],
+                            json.dumps({'snapshot': snapshot,
+                                        'pizzeria_id': pizzeria_id}))
+        else:
+            record_order(_database, snapshot, pizzeria_id, datetime.now())
+
         delivery = context.bot_data[f'{chat_id}_delivery']
         if delivery:
-            customer_address_id, deliveryman_id = delivery.split('$')
-            raw_entry = get_entry_from_flow(store_access_token,
-                                            'customer_address',
-                                            customer_address_id)
-            coords = (raw_entry['data']['latitude'],
-                      raw_entry['data']['longitude'])
-
-            message = _database.json().get(f'{chat_id}_menu')['menu']
-            bot.send_message(deliveryman_id, text=message,
-                             parse_mode=ParseMode.HTML)
-            bot.send_location(deliveryman_id, latitude=coords[0],
-                              longitude=coords[1], protect_content=True)
+            if not customer_coords:
+                # saved before coordinates were kept in the order
+                raw_entry = get_entry_from_flow(store_access_token,
+                                                'customer_address',
+                                                customer_address_id)
+                customer_coords = (raw_entry['data']['latitude'],
+                                   raw_entry['data']['longitude'])
+            products = parse_products(get_products(store_access_token))
+            enqueue_delivery(_database, pizzeria_id, {
+                **delivery,
+                'chat_id': chat_id,
+                'customer': tuple(map(float, customer_coords)),
+                'message': render_order_message(snapshot, products),
+            })
+            if not context.bot_data['dispatch_window']:
+                dispatch_orders(context.bot, _database, pizzeria_id)
             context.bot_data[f'{chat_id}_delivery'] = None
 
         delete_all_cart_products(store_access_token, chat_id)
+        _database.delete(f'{chat_id}_order_snapshot')
+        context.bot_data['card_cache'].delete(('cart', chat_id))
         context.job_queue.run_once(remind_about_order, 3600, context=chat_id)
         return 'START'
     return 'HANDLE_PAYMENT_CHOICE'
 
 
+def dispatch_orders(bot, _database, pizzeria_id: str) -> None:
+    '''Sends queued orders of the pizzeria to couriers in batches.'''
+    orders = take_orders(_database, pizzeria_id)
+    failed_orders = []
+    for batch in group_orders(orders):
+        courier = pick_courier(_database, pizzeria_id, batch[-1]['couriers'])
+        try:
+            bot.send_message(courier, text=render_batch_message(batch),
+                             parse_mode=ParseMode.HTML, protect_content=True,
+                             disable_web_page_preview=True)
+        except TelegramError as err:
+            logger.warning(f'Не удалось отправить заказы доставщику\n{err}\n')
+            failed_orders += batch
+    failed_orders.sort(key=orders.index)
+    retried_orders = []
+    for order in failed_orders:
+        order['attempts'] = order.get('attempts', 0) + 1
+        if order['attempts'] < DISPATCH_ATTEMPTS:
+            retried_orders.append(order)
+            continue
+        logger.error(f'Заказ не передан доставщикам пиццерии {pizzeria_id} '
+                     f'за {DISPATCH_ATTEMPTS} попыток')
+        if not order.get('chat_id'):
+            continue
+        try:
+            bot.send_message(order['chat_id'],
+                             text='Не удалось передать заказ доставщику, '
+                                  'пожалуйста, свяжитесь с пиццерией')
+        except TelegramError as err:
+            logger.warning(f'Ошибка в работе телеграм бота\n{err}\n')
+    requeue_orders(_database, pizzeria_id, retried_orders)
+
+
+def flush_dispatch_queues(context: CallbackContext) -> None:
+    _database = context.bot_data['_database']
+    for pizzeria_id in get_queued_pizzerias(_database):
+        dispatch_orders(context.bot, _database, pizzeria_id)
+
+
 def pay_for_pizza(update: Update, context: CallbackContext) -> None:
     '''Sends an invoice without shipping-payment.'''
     _database = context.bot_data['_database']
+    store_access_token = context.bot_data['store_access_token']
     query = update.callback_query
     chat_id = query.message.chat_id
     title = 'Payment Example'
@@ -475,8 +856,9 @@ def pay_for_pizza(update: Update, context: CallbackContext) -> None:
     payload = 'pizza_payment'
     provider_token = context.bot_data['payment_token']
     currency = 'RUB'
-    price = _database.json().get(f'{chat_id}_menu')['price']
-    prices = [LabeledPrice('Test', int(price) * 100)]
+    snapshot = get_order_snapshot(store_access_token, chat_id, _database,
+                                  context.bot_data['snapshot_ttl'])
+    prices = [LabeledPrice('Test', snapshot['total'])]
     context.bot.send_invoice(
         chat_id, title, description, payload, provider_token, currency, prices
     )
@@ -491,25 +873,105 @@ def pre_checkout_callback(update: Update, context: CallbackContext) -> None:
 
 
 def successful_payment_callback(update: Update, context: CallbackContext) -> None:
+    _database = context.bot_data['_database']
+    chat_id = update.message.chat_id
+    raw_order = _database.get(f'{chat_id}_unpaid_order')
+    if raw_order:
+        order = json.loads(raw_order)
+        record_order(_database, order['snapshot'], order['pizzeria_id'],
+                     datetime.now())
+        _database.delete(f'{chat_id}_unpaid_order')
     update.message.reply_text('Благодарим за заказ! Оплата прошла успешно!')
 
 
+def get_store_access_token(bot_data: dict) -> str:
+    client_secret = bot_data['client_secret']
+    client_id = bot_data['client_id']
+    token_lifetime = bot_data['token_lifetime']
+    _database = bot_data['_database']
+    store_access_token = _database.get('store_access_token')
+    if not store_access_token:
+        store_access_token = get_access_token(client_secret, client_id)
+        _database.setex('store_access_token', token_lifetime,
+                        store_access_token)
+    else:
+        store_access_token = store_access_token.decode('utf-8')
+        # tokens saved before a restart are unknown to moltin_api
+        register_token(client_id, store_access_token)
+    return store_access_token
+
+
+def refresh_catalog_index(context: CallbackContext) -> None:
+    try:
+        store_access_token = get_store_access_token(context.bot_data)
+        products = parse_products(get_products(store_access_token))
+    except requests.exceptions.RequestException as err:
+        logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
+        return
+    context.bot_data['catalog_index'].update(products)
+    if context.bot_data['prefetch_cards']:
+        warm_best_selling_images(context.bot_data, store_access_token,
+                                 products)
+
+
+def warm_best_selling_images(bot_data: dict, store_access_token: str,
+                             products: dict) -> None:
+    '''Resolves images of the best sellers before anyone opens them.'''
+    product_sales = get_product_sales(bot_data['_database'])
+    best_sellers = list(sort_by_popularity(products, product_sales).values())
+    for product_data in best_sellers[:bot_data['products_per_page']]:
+        try:
+            get_image_handle(bot_data, store_access_token,
+                             product_data.get('image_id'))
+        except requests.exceptions.RequestException as err:
+            logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
+            return
+
+
+def handle_inline_query(update: Update, context: CallbackContext) -> None:
+    catalog_index = context.bot_data['catalog_index']
+    query = update.inline_query
+    results = []
+    for product_id, product in catalog_index.search(query.query):
+        message = dedent(f'''
+        <b>{product.get('name')}</b>
+
+        Стоимость: <u>{product.get('price'):.2f} РУБ</u>
+
+        {product.get('description')}
+        ''')
+        button = InlineKeyboardButton(
+            'Открыть в боте',
+            url=f'https://t.me/{context.bot.username}?start={product_id}'
+        )
+        results.append(InlineQueryResultArticle(
+            id=product_id,
+            title=product.get('name'),
+            description=f"{product.get('price'):.2f} РУБ. "
+                        f"{product.get('description')}",
+            input_message_content=InputTextMessageContent(
+                message, parse_mode=ParseMode.HTML),
+            reply_markup=InlineKeyboardMarkup([[button]]),
+        ))
+    query.answer(results, cache_time=300)
+
+
+def is_repeated_callback(query, bot_data: dict) -> bool:
+    '''Checks whether the same button was pressed in this chat just now.'''
+    window = bot_data['callback_debounce_ms']
+    if not window:
+        return False
+    _database = bot_data['_database']
+    key = f'{query.message.chat_id}_callback_{query.data}'
+    return not _database.set(key, 1, px=window, nx=True)
+
+
 def handle_users_reply(update: Update, context: CallbackContext) -> None:
-    client_secret = context.bot_data['client_secret']
-    client_id = context.bot_data['client_id']
-    token_lifetime = context.bot_data['token_lifetime']
-    client_id = context.bot_data['client_id']
     _database = context.bot_data['_database']
     try:
-        store_access_token = _database.get('store_access_token')
-        if not store_access_token:
-            store_access_token = get_access_token(client_secret, client_id)
-            _database.setex('store_access_token', token_lifetime,
-                            store_access_token)
-        else:
-            store_access_token = store_access_token.decode('utf-8')
+        store_access_token = get_store_access_token(context.bot_data)
         context.bot_data['store_access_token'] = store_access_token
-    except requests.exceptions.HTTPError as err:
+    except requests.exceptions.RequestException as err:
         logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
 
     if update.message:
@@ -518,9 +980,12 @@ def handle_users_reply(update: Update, context: CallbackContext) -> None:
     elif update.callback_query:
         user_reply = update.callback_query.data
         chat_id = update.callback_query.message.chat_id
+        if is_repeated_callback(update.callback_query, context.bot_data):
+            update.callback_query.answer()
+            return
     else:
         return
-    if user_reply == '/start':
+    if user_reply and user_reply.startswith('/start'):
         user_state = 'START'
     else:
         user_state = _database.get(chat_id).decode('utf-8')
@@ -535,26 +1000,98 @@ def handle_users_reply(update: Update, context: CallbackContext) -> None:
         'HANDLE_PAYMENT_CHOICE': handle_payment_choice
     }
     state_handler = states_functions[user_state]
+    annotate_update(chat_state=user_state, handler=state_handler.__name__)
     try:
         next_state = state_handler(update, context)
         _database.set(chat_id, next_state)
-    except requests.exceptions.HTTPError as err:
+    except requests.exceptions.RequestException as err:
         logger.warning(f'Ошибка в работе api.moltin.com\n{err}\n')
     except Exception as err:
         logger.warning(f'Ошибка в работе телеграм бота\n{err}\n')
 
 
+def run_in_background(bot_data: dict, func, *args) -> None:
+    '''Runs `func` in the worker pool shared by all stores.'''
+    def log_error(future):
+        if future.exception():
+            logger.warning(f'Ошибка в фоновой задаче\n{future.exception()}\n')
+
+    bot_data['executor'].submit(func, *args).add_done_callback(log_error)
+
+
+def fill_bot_data(bot_data: dict, store: dict, settings: dict,
+                  _database) -> None:
+    bot_data.update(settings)
+    bot_data['store_name'] = store['name']
+    bot_data['_database'] = _database
+    bot_data['client_id'] = store['client_id']
+    bot_data['token_lifetime'] = store['token_lifetime']
+    bot_data['client_secret'] = store['client_secret']
+    bot_data['products_per_page'] = store['products_per_page']
+    bot_data['payment_token'] = store['payment_token']
+    bot_data['card_cache'] = CardCache(
+        max_size=settings['card_cache_size'],
+        ttl=settings['card_cache_ttl'],
+    )
+    bot_data['catalog_index'] = CatalogIndex()
+
+
+def read_settings(env: Env) -> dict:
+    '''Reads settings shared by all stores of the process.'''
+    return {
+        'snapshot_ttl': env.int('ORDER_SNAPSHOT_TTL', 86400),
+        'callback_debounce_ms': env.int('CALLBACK_DEBOUNCE_MS', 1000),
+        'optimistic_cart': env.bool('OPTIMISTIC_CART', False),
+        'prefetch_cards': env.bool('PREFETCH_CARDS', False),
+        'prefetch_adjacent_page': env.bool('PREFETCH_ADJACENT_PAGE', False),
+        'card_cache_size': env.int('CARD_CACHE_SIZE', 1000),
+        'card_cache_ttl': env.int('CARD_CACHE_TTL', 60),
+        'catalog_refresh_interval': env.int('CATALOG_REFRESH_INTERVAL', 300),
+        'dispatch_window': env.int('DISPATCH_WINDOW', 60),
+        'geocoder_api': env.str('YANDEX_GEOCODER_APIKEY'),
+        'executor': ThreadPoolExecutor(max_workers=env.int('WORKERS', 8),
+                                       thread_name_prefix='bot_worker'),
+    }
+
+
+def create_updater(store: dict, settings: dict, _database,
+                   users_reply_handler) -> Updater:
+    # handlers do not use run_async, background work goes to the shared pool
+    updater = Updater(store['tg_token'], workers=1)
+    dispatcher = updater.dispatcher
+    fill_bot_data(dispatcher.bot_data, store, settings, _database)
+    updater.job_queue.run_repeating(
+        refresh_catalog_index,
+        interval=settings['catalog_refresh_interval'],
+        first=0,
+    )
+    # without a window orders go out at once, the job only retries failures
+    updater.job_queue.run_repeating(
+        flush_dispatch_queues, interval=settings['dispatch_window'] or 60
+    )
+    dispatcher.add_handler(InlineQueryHandler(handle_inline_query))
+    dispatcher.add_handler(CallbackQueryHandler(users_reply_handler))
+    dispatcher.add_handler(MessageHandler(
+        Filters.text | Filters.location,
+        users_reply_handler)
+    )
+    dispatcher.add_handler(CommandHandler('start', users_reply_handler))
+    dispatcher.add_handler(MessageHandler(
+        Filters.successful_payment, successful_payment_callback)
+    )
+    dispatcher.add_handler(PreCheckoutQueryHandler(pre_checkout_callback))
+    return updater
+
+
 def main():
     env = Env()
     env.read_env()
-    client_secret = env.str('ELASTICPATH_CLIENT_SECRET')
-    client_id = env.str('ELASTICPATH_CLIENT_ID')
-    token_lifetime = env.int('TOKEN_LIFETIME')
-    products_per_page = env.int('PRODUCTS_PER_PAGE', 6)
+    stores_config = env.str('STORES_CONFIG', '')
     database_password = env.str("REDIS_PASSWORD")
     database_host = env.str("REDIS_HOST")
     database_port = env.int("REDIS_PORT")
-    geocoder_api = env.str('YANDEX_GEOCODER_APIKEY')
+    set_hedged_reads(env.bool('MOLTIN_HEDGED_REQUESTS', False))
+    settings = read_settings(env)
     logging.basicConfig(
         format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
         level=logging.INFO
@@ -562,30 +1099,54 @@ def main():
     logger.setLevel(logging.INFO)
     _database = redis.Redis(host=database_host, port=database_port,
                             password=database_password)
-    tg_token = env.str('PIZZERIA_BOT_TG_TOKEN')
-    payment_token = env.str('PAYMENT_TOKEN')
-    updater = Updater(tg_token)
-    dispatcher = updater.dispatcher
-    dispatcher.bot_data['_database'] = _database
-    dispatcher.bot_data['client_id'] = client_id
-    dispatcher.bot_data['token_lifetime'] = token_lifetime
-    dispatcher.bot_data['client_secret'] = client_secret
-    dispatcher.bot_data['products_per_page'] = products_per_page
-    dispatcher.bot_data['geocoder_api'] = geocoder_api
-    dispatcher.bot_data['payment_token'] = payment_token
-    dispatcher.add_handler(CallbackQueryHandler(handle_users_reply))
-    dispatcher.add_handler(MessageHandler(
-        Filters.text | Filters.location,
-        handle_users_reply)
-    )
-    dispatcher.add_handler(CommandHandler('start', handle_users_reply))
-    dispatcher.add_handler(MessageHandler(
-        Filters.successful_payment, successful_payment_callback)
-    )
-    dispatcher.add_handler(PreCheckoutQueryHandler(pre_checkout_callback))
-    logger.info('Телеграм бот запущен')
-    updater.start_polling()
-    updater.idle()
+    users_reply_handler = handle_users_reply
+    if env.bool('PROFILE_UPDATES', False):
+        profiler = UpdateProfiler(
+            env.str('PROFILE_DIR', 'profiles'),
+            sample_rate=env.float('PROFILE_SAMPLE_RATE', 0.01),
+            slow_threshold=env.float('PROFILE_SLOW_THRESHOLD', 2),
+            max_files=env.int('PROFILE_MAX_FILES', 200),
+        )
+        users_reply_handler = profiler.wrap(handle_users_reply)
+    recorder = None
+    if env.bool('CAPTURE_TRAFFIC', False):
+        recorder = TrafficRecorder(env.str('CAPTURE_PATH', 'traffic.jsonl'),
+                                   salt=env.str('CAPTURE_SALT', None))
+        recorder.record_session(http_session)
+        users_reply_handler = recorder.wrap(users_reply_handler)
+
+    if stores_config:
+        updaters = []
+        for store in load_stores(stores_config):
+            store.setdefault('token_lifetime', env.int('TOKEN_LIFETIME', 3600))
+            store.setdefault('products_per_page',
+                             env.int('PRODUCTS_PER_PAGE', 6))
+            store_database = NamespacedRedis(_database, store['name'])
+            if recorder:
+                store_database = recorder.record_redis(store_database)
+            updaters.append(create_updater(store, settings, store_database,
+                                           users_reply_handler))
+    else:
+        store = {
+            'name': '',
+            'tg_token': env.str('PIZZERIA_BOT_TG_TOKEN'),
+            'payment_token': env.str('PAYMENT_TOKEN'),
+            'client_id': env.str('ELASTICPATH_CLIENT_ID'),
+            'client_secret': env.str('ELASTICPATH_CLIENT_SECRET'),
+            'token_lifetime': env.int('TOKEN_LIFETIME'),
+            'products_per_page': env.int('PRODUCTS_PER_PAGE', 6),
+        }
+        if recorder:
+            _database = recorder.record_redis(_database)
+        updaters = [create_updater(store, settings, _database,
+                                   users_reply_handler)]
+    for updater in updaters:
+        updater.start_polling()
+    logger.info(f'Телеграм бот запущен, магазинов: {len(updaters)}')
+    updaters[0].idle()
+    for updater in updaters[1:]:
+        updater.stop()
+    settings['executor'].shutdown()
 
 
 if __name__ == '__main__':
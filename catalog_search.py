@@ -0,0 +1,146 @@
+import re
+import threading
+from collections import OrderedDict, defaultdict
+
+from transliterate import translit
+
+WORD_PATTERN = re.compile(r'\w+')
+
+
+def normalize(text: str) -> str:
+    return text.lower().replace('ё', 'е')
+
+
+def split_words(text: str) -> list[str]:
+    return WORD_PATTERN.findall(normalize(text))
+
+
+def get_trigrams(word: str) -> set[str]:
+    return {word[i:i + 3] for i in range(len(word) - 2)}
+
+
+class CatalogIndex:
+    '''In-memory search index over product names and descriptions.
+
+    Every word is indexed by all of its prefixes and by its trigrams, both in
+    Cyrillic and transliterated to Latin, so "пепп", "pepp" and "ерони" all
+    find a pepperoni. Results of recent queries are kept in an LRU cache which
+    is reset whenever the catalog changes.
+    '''
+
+    def __init__(self, cache_size: int = 256) -> None:
+        self.products = {}
+        self.cache_size = cache_size
+        self._words = {}
+        self._name_words = {}
+        self._prefixes = defaultdict(set)
+        self._trigrams = defaultdict(set)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def update(self, products: dict) -> None:
+        '''Reindexes only added, changed and removed products.'''
+        with self._lock:
+            self._update(products)
+
+    def _update(self, products: dict) -> None:
+        changed = False
+        for product_id in self.products.keys() - products.keys():
+            self._remove(product_id)
+            changed = True
+        for product_id, product in products.items():
+            indexed_product = self.products.get(product_id)
+            if indexed_product == product:
+                continue
+            if indexed_product:
+                self._remove(product_id)
+            self._add(product_id, product)
+            changed = True
+        if changed:
+            self._cache.clear()
+
+    def _get_product_words(self, text: str) -> set[str]:
+        words = set(split_words(text))
+        words |= set(split_words(translit(text, 'ru', reversed=True)))
+        return words
+
+    def _add(self, product_id: str, product: dict) -> None:
+        name_words = self._get_product_words(product.get('name') or '')
+        words = name_words | self._get_product_words(
+            product.get('description') or '')
+        for word in words:
+            for end in range(1, len(word) + 1):
+                self._prefixes[word[:end]].add(product_id)
+            for trigram in get_trigrams(word):
+                self._trigrams[trigram].add(product_id)
+        self.products[product_id] = product
+        self._words[product_id] = words
+        self._name_words[product_id] = name_words
+
+    def _remove(self, product_id: str) -> None:
+        for word in self._words.pop(product_id):
+            for end in range(1, len(word) + 1):
+                self._discard(self._prefixes, word[:end], product_id)
+            for trigram in get_trigrams(word):
+                self._discard(self._trigrams, trigram, product_id)
+        del self._name_words[product_id]
+        del self.products[product_id]
+
+    @staticmethod
+    def _discard(index: dict, key: str, product_id: str) -> None:
+        product_ids = index[key]
+        product_ids.discard(product_id)
+        if not product_ids:
+            del index[key]
+
+    def _find_word(self, word: str) -> set[str]:
+        product_ids = set(self._prefixes.get(word, ()))
+        if len(word) < 3:
+            return product_ids
+        candidates = None
+        for trigram in get_trigrams(word):
+            trigram_ids = self._trigrams.get(trigram, set())
+            candidates = trigram_ids if candidates is None \
+                else candidates & trigram_ids
+            if not candidates:
+                return product_ids
+        for product_id in candidates - product_ids:
+            if any(word in product_word
+                   for product_word in self._words[product_id]):
+                product_ids.add(product_id)
+        return product_ids
+
+    def search(self, query: str, limit: int = 50) -> list[tuple[str, dict]]:
+        '''Returns ids and data of found products.
+
+        Product data is taken under the lock, so a concurrent refresh cannot
+        remove a found product before the caller reads it.
+        '''
+        with self._lock:
+            product_ids = self._search(tuple(split_words(query)), limit)
+            return [(product_id, self.products[product_id])
+                    for product_id in product_ids]
+
+    def _search(self, words: tuple[str, ...], limit: int) -> tuple[str, ...]:
+        if words in self._cache:
+            self._cache.move_to_end(words)
+            return self._cache[words]
+        if words:
+            product_ids = set.intersection(
+                *(self._find_word(word) for word in words))
+        else:
+            product_ids = set(self.products)
+
+        def get_rank(product_id):
+            name_matches = sum(
+                any(word in name_word
+                    for name_word in self._name_words[product_id])
+                for word in words
+            )
+            return -name_matches, self.products[product_id].get('name')
+
+        found_products = tuple(sorted(product_ids, key=get_rank)[:limit])
+        self._cache[words] = found_products
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return found_products
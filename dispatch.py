@@ -0,0 +1,87 @@
+import json
+from textwrap import dedent
+
+from geopy import distance
+
+DISPATCH_PIZZERIAS = 'dispatch_pizzerias'
+BATCH_RADIUS_KM = 2
+BATCH_SIZE = 5
+DISPATCH_ATTEMPTS = 5
+
+
+def enqueue_delivery(_database, pizzeria_id: str, order: dict) -> None:
+    '''Puts the order into the delivery queue of the pizzeria.
+
+    The order holds `couriers` of the pizzeria, `pizzeria` and `customer`
+    coordinates, the customer `chat_id` and the order `message` for the
+    courier.
+    '''
+    with _database.pipeline() as pipe:
+        pipe.rpush(f'dispatch_{pizzeria_id}', json.dumps(order))
+        pipe.sadd(DISPATCH_PIZZERIAS, pizzeria_id)
+        pipe.execute()
+
+
+def requeue_orders(_database, pizzeria_id: str, orders: list[dict]) -> None:
+    '''Returns undelivered orders to the head of the queue in their order.'''
+    if not orders:
+        return
+    with _database.pipeline() as pipe:
+        pipe.lpush(f'dispatch_{pizzeria_id}',
+                   *(json.dumps(order) for order in reversed(orders)))
+        pipe.sadd(DISPATCH_PIZZERIAS, pizzeria_id)
+        pipe.execute()
+
+
+def take_orders(_database, pizzeria_id: str) -> list[dict]:
+    with _database.pipeline() as pipe:
+        pipe.lrange(f'dispatch_{pizzeria_id}', 0, -1)
+        pipe.delete(f'dispatch_{pizzeria_id}')
+        raw_orders, _ = pipe.execute()
+    return [json.loads(raw_order) for raw_order in raw_orders]
+
+
+def get_queued_pizzerias(_database) -> list[str]:
+    return [pizzeria_id.decode('utf-8')
+            for pizzeria_id in _database.smembers(DISPATCH_PIZZERIAS)]
+
+
+def group_orders(orders: list[dict], radius_km: float = BATCH_RADIUS_KM,
+                 batch_size: int = BATCH_SIZE) -> list[list[dict]]:
+    '''Groups orders lying within `radius_km` of the earliest order.'''
+    batches = []
+    orders = list(orders)
+    while orders:
+        first_order = orders.pop(0)
+        batch = [first_order]
+        for order in list(orders):
+            if len(batch) == batch_size:
+                break
+            path = distance.distance(first_order['customer'],
+                                     order['customer']).km
+            if path <= radius_km:
+                batch.append(order)
+                orders.remove(order)
+        batches.append(batch)
+    return batches
+
+
+def pick_courier(_database, pizzeria_id: str, couriers: list[str]) -> str:
+    '''Chooses couriers of the pizzeria in turn.'''
+    turn = _database.incr(f'dispatch_turn_{pizzeria_id}')
+    return couriers[turn % len(couriers)]
+
+
+def render_batch_message(batch: list[dict]) -> str:
+    points = [batch[0]['pizzeria']] + [order['customer'] for order in batch]
+    route = '~'.join(f'{lat},{lon}' for lat, lon in points)
+    message = f'<b>Заказов в поездке: {len(batch)}</b>\n'
+    for number, order in enumerate(batch, start=1):
+        lat, lon = order['customer']
+        message += dedent(f'''
+        <b>Заказ №{number}</b> — <a href="https://yandex.ru/maps/?pt={lon},{lat}&amp;z=17">на карте</a>
+        ''')
+        message += order['message'] + '\n'
+    message += dedent(f'''
+    <a href="https://yandex.ru/maps/?rtext={route}&amp;rtt=auto">Маршрут по всем адресам</a>''')
+    return message
@@ -1,36 +1,222 @@
+import logging
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+
 from transliterate import slugify
 
 import requests
 
+from resilience import (CircuitBreaker, CircuitOpenError, LatencyTracker,
+                        SingleFlight, hedged_call)
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds for every group of endpoints
+TIMEOUTS = {
+    'auth': (3.05, 10),
+    'catalog': (3.05, 10),
+    'files': (3.05, 10),
+    'cart': (3.05, 7),
+    'flows': (3.05, 7),
+    'admin': (3.05, 30),
+}
+HEDGE_PERCENTILE = 95
+DEFAULT_HEDGE_DELAY = 1.0
+TOKENS_PER_STORE = 2
+HTTP_POOL_SIZE = 32
+CART_VERSIONS_LIMIT = 10000
+CART_PATTERN = re.compile(r'/v2/carts/[^/?]+')
+
+# one connection pool for every store served by the process
+http_session = requests.Session()
+http_session.mount('https://', requests.adapters.HTTPAdapter(
+    pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE))
+
+# breaker, latencies, fallback data and recent tokens of every store,
+# keyed by the client id; requests with unknown tokens share the None store
+_stores = {}
+_token_owners = {}
+_stores_lock = threading.Lock()
+in_flight_reads = SingleFlight()
+_hedged_reads = False
+# bumped by every cart change, so reads after it never join older reads
+_cart_versions = OrderedDict()
+_cart_versions_lock = threading.Lock()
+
+
+def set_hedged_reads(enabled: bool) -> None:
+    global _hedged_reads
+    _hedged_reads = enabled
+
+
+def _get_store(client_id: str | None) -> dict:
+    store = _stores.get(client_id)
+    if store is None:
+        store = {
+            'breaker': CircuitBreaker('api.moltin.com'),
+            'latencies': LatencyTracker(),
+            'fallback': {},
+            'tokens': deque(),
+        }
+        _stores[client_id] = store
+    return store
+
+
+def register_token(client_id: str, store_access_token: str) -> None:
+    '''Tells which store the token belongs to.
+
+    Only the last TOKENS_PER_STORE tokens of every store are kept, so
+    rotating tokens do not pile up.
+    '''
+    with _stores_lock:
+        if _token_owners.get(store_access_token) == client_id:
+            return
+        tokens = _get_store(client_id)['tokens']
+        tokens.append(store_access_token)
+        _token_owners[store_access_token] = client_id
+        while len(tokens) > TOKENS_PER_STORE:
+            _token_owners.pop(tokens.popleft(), None)
+
+
+def _find_store(store_access_token: str | None) -> dict:
+    with _stores_lock:
+        return _get_store(_token_owners.get(store_access_token))
+
+
+def _get_upstream(kwargs: dict) -> tuple[CircuitBreaker, LatencyTracker]:
+    '''Returns the breaker and latencies of the store sending the request.
+
+    Every store has its own state, so failures of one misconfigured store do
+    not open the breaker for the others.
+    '''
+    client_id = (kwargs.get('data') or {}).get('client_id')
+    if client_id:
+        with _stores_lock:
+            store = _get_store(client_id)
+    else:
+        authorization = kwargs.get('headers', {}).get('Authorization', '')
+        store = _find_store(authorization.removeprefix('Bearer '))
+    return store['breaker'], store['latencies']
+
+
+def _timed_request(upstream: tuple[CircuitBreaker, LatencyTracker],
+                   method: str, url: str, endpoint: str, **kwargs):
+    breaker, latencies = upstream
+    started_at = time.monotonic()
+    response = breaker.call(http_session.request, method, url, **kwargs)
+    latencies.record(endpoint, time.monotonic() - started_at)
+    return response
+
+
+def _get_cart_version(cart_key: tuple) -> int:
+    with _cart_versions_lock:
+        return _cart_versions.get(cart_key, 0)
+
+
+def _bump_cart_version(cart_key: tuple) -> None:
+    with _cart_versions_lock:
+        _cart_versions[cart_key] = _cart_versions.get(cart_key, 0) + 1
+        _cart_versions.move_to_end(cart_key)
+        if len(_cart_versions) > CART_VERSIONS_LIMIT:
+            _cart_versions.popitem(last=False)
+
+
+def _request(method: str, url: str, endpoint: str, hedge: bool = False,
+             **kwargs) -> requests.Response:
+    '''Sends a request, identical concurrent GETs share one response.
+
+    A cart read joins only reads started after the last change of the cart,
+    so it always sees the changes made before it.
+    '''
+    authorization = kwargs.get('headers', {}).get('Authorization')
+    cart = CART_PATTERN.search(url)
+    cart_key = cart and (authorization, cart.group())
+    if method == 'GET' and not kwargs.get('stream'):
+        key = (url, authorization, repr(kwargs.get('params')),
+               cart_key and _get_cart_version(cart_key))
+        return in_flight_reads.call(key, _send_request, method, url,
+                                    endpoint, hedge, **kwargs)
+    if not cart_key:
+        return _send_request(method, url, endpoint, hedge, **kwargs)
+    _bump_cart_version(cart_key)
+    try:
+        return _send_request(method, url, endpoint, hedge, **kwargs)
+    finally:
+        _bump_cart_version(cart_key)
+
+
+def _send_request(method: str, url: str, endpoint: str, hedge: bool,
+                  **kwargs) -> requests.Response:
+    kwargs.setdefault('timeout', TIMEOUTS[endpoint])
+    upstream = _get_upstream(kwargs)
+    if hedge and _hedged_reads:
+        _, latencies = upstream
+        delay = latencies.percentile(endpoint, HEDGE_PERCENTILE) \
+            or DEFAULT_HEDGE_DELAY
+        return hedged_call(_timed_request, delay, upstream, method, url,
+                           endpoint, **kwargs)
+    return _timed_request(upstream, method, url, endpoint, **kwargs)
+
+
+def _with_fallback(store_access_token: str, name: str, fetch):
+    '''Returns cached data when api.moltin.com is unavailable.
+
+    The last data of every kind is kept per store, so stores never evict
+    each other's data and a new token of the store still finds it.
+    '''
+    try:
+        data = fetch()
+    except (CircuitOpenError, requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout, requests.exceptions.HTTPError) as err:
+        response = getattr(err, 'response', None)
+        if response is not None and response.status_code < 500:
+            raise
+        fallback = _find_store(store_access_token)['fallback']
+        with _stores_lock:
+            if name not in fallback:
+                raise
+            data = fallback[name]
+        logger.warning(f'api.moltin.com недоступен, данные из кэша\n{err}\n')
+        return data
+    fallback = _find_store(store_access_token)['fallback']
+    with _stores_lock:
+        fallback[name] = data
+    return data
+
 
 def get_access_token(client_secret: str, client_id: str) -> str:
     url = 'https://api.moltin.com/oauth/access_token'
     data = {'grant_type': 'client_credentials',
             'client_secret': client_secret, 'client_id': client_id}
-    response = requests.post(url, data=data)
+    response = _request('POST', url, 'auth', data=data)
     response.raise_for_status()
     access_token = response.json().get('access_token')
+    register_token(client_id, access_token)
     return access_token
 
 
 def get_products(store_access_token: str) -> tuple[list, list]:
+    url = 'https://api.moltin.com/catalog/products'
     headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.get('https://api.moltin.com/catalog/products',
+
+    def fetch():
+        response = _request('GET', url, 'catalog', hedge=True,
                             headers=headers)
-    response.raise_for_status()
-    raw_products = response.json().get('data')
+        response.raise_for_status()
+        return response.json().get('data')
+
+    raw_products = _with_fallback(store_access_token, 'products', fetch)
     return raw_products
 
 
-def get_product_image(store_access_token: str, image_id: str):
+def get_product_image_link(store_access_token: str, image_id: str) -> str:
     headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.get(f'https://api.moltin.com/v2/files/{image_id}',
-                            headers=headers)
-    response.raise_for_status()
-    image_link = response.json().get('data').get('link').get('href')
-    response = requests.get(image_link, stream=True)
+    response = _request('GET', f'https://api.moltin.com/v2/files/{image_id}',
+                        'files', headers=headers)
     response.raise_for_status()
-    return response.raw
+    return response.json().get('data').get('link').get('href')
 
 
 def put_product_in_cart(store_access_token: str, product_id: str,
@@ -39,7 +225,7 @@ def put_product_in_cart(store_access_token: str, product_id: str,
     headers = {'Authorization': f'Bearer {store_access_token}'}
     body = {"data": {'quantity': quantity, 'type': 'cart_item',
                      'id': product_id}}
-    response = requests.post(url, headers=headers, json=body)
+    response = _request('POST', url, 'cart', headers=headers, json=body)
     response.raise_for_status()
     return response.json()
 
@@ -47,7 +233,7 @@ def put_product_in_cart(store_access_token: str, product_id: str,
 def get_user_cart(store_access_token: str, chat_id: int) -> dict:
     url = f'https://api.moltin.com/v2/carts/{chat_id}/items'
     headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.get(url, headers=headers)
+    response = _request('GET', url, 'cart', hedge=True, headers=headers)
     response.raise_for_status()
     return response.json()
 
@@ -56,14 +242,14 @@ def delete_cart_product(store_access_token: str, chat_id: int,
                         product_id: str) -> None:
     url = f'https://api.moltin.com/v2/carts/{chat_id}/items/{product_id}'
     headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.delete(url, headers=headers)
+    response = _request('DELETE', url, 'cart', headers=headers)
     response.raise_for_status()
 
 
 def delete_all_cart_products(store_access_token: str, chat_id: int) -> None:
     url = f'https://api.moltin.com/v2/carts/{chat_id}/items'
     headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.delete(url, headers=headers)
+    response = _request('DELETE', url, 'cart', headers=headers)
     response.raise_for_status()
 
 
@@ -73,7 +259,7 @@ def create_customer(store_access_token: str, customer_name: str,
     headers = {'Authorization': f'Bearer {store_access_token}'}
     body = {"data": {'name': customer_name, 'type': 'customer',
                      'email': customer_email}}
-    response = requests.post(url, headers=headers, json=body)
+    response = _request('POST', url, 'admin', headers=headers, json=body)
     response.raise_for_status()
     customer_id = response.json().get('data').get('id')
     return customer_id
@@ -93,7 +279,8 @@ def create_product(store_access_token: str, product_data: dict) -> tuple[str, st
                     'commodity_type': 'physical',
                 }
     }
-    response = requests.post(url, headers=headers, json={'data': json_data})
+    response = _request('POST', url, 'admin', headers=headers,
+                        json={'data': json_data})
     response.raise_for_status()
     product = response.json()
     product_sku = product['data']['attributes']['sku']
@@ -115,7 +302,8 @@ def create_corrency(store_access_token: str) -> None:
         'default': True,
         'enabled': True
     }
-    response = requests.post(url, headers=headers, json={'data': json_data})
+    response = _request('POST', url, 'admin', headers=headers,
+                        json={'data': json_data})
     response.raise_for_status()
 
 
@@ -128,7 +316,8 @@ def create_price_book(store_access_token: str) -> str:
             'name': 'Pizzeria price book',
         }
     }
-    response = requests.post(url, headers=headers, json={'data': json_data})
+    response = _request('POST', url, 'admin', headers=headers,
+                        json={'data': json_data})
     response.raise_for_status()
     return response.json()['data']['id']
 
@@ -149,7 +338,8 @@ def set_price_for_product(store_access_token: str, price_book_id: str,
             'sku': product_sku
         }
     }
-    response = requests.post(url, headers=headers, json={'data': json_data})
+    response = _request('POST', url, 'admin', headers=headers,
+                        json={'data': json_data})
     response.raise_for_status()
 
 
@@ -159,7 +349,7 @@ def upload_image(store_access_token: str, image_url: str) -> None:
     files = {
         'file_location': (None, image_url),
     }
-    response = requests.post(url, headers=headers, files=files)
+    response = _request('POST', url, 'admin', headers=headers, files=files)
     response.raise_for_status()
     return response.json()['data']['id']
 
@@ -172,7 +362,8 @@ def create_image_relationship(store_access_token: str, image_id: str,
         'type': 'file',
         'id': f'{image_id}',
     }
-    response = requests.post(url, headers=headers, json={'data': json_data})
+    response = _request('POST', url, 'admin', headers=headers,
+                        json={'data': json_data})
     response.raise_for_status()
 
 
@@ -188,16 +379,43 @@ def create_flow(store_access_token: str, name: str) -> str:
             'enabled': True,
         },
     }
-    response = requests.post(url, headers=headers, json=json_data)
+    response = _request('POST', url, 'admin', headers=headers, json=json_data)
     response.raise_for_status()
     return response.json()['data']['id']
 
 
+def get_flows(store_access_token: str) -> list:
+    url = 'https://api.moltin.com/v2/flows'
+    headers = {'Authorization': f'Bearer {store_access_token}'}
+    response = _request('GET', url, 'admin', headers=headers)
+    response.raise_for_status()
+    return response.json()['data']
+
+
+def get_flow_fields(store_access_token: str, flow_slug: str) -> list:
+    url = f'https://api.moltin.com/v2/flows/{flow_slug}/fields'
+    headers = {'Authorization': f'Bearer {store_access_token}'}
+    response = _request('GET', url, 'admin', headers=headers)
+    response.raise_for_status()
+    return response.json()['data']
+
+
 def create_field(store_access_token: str, json_data: dict, flow_id: str) -> None:
     url = 'https://api.moltin.com/v2/fields'
     headers = {'Authorization': f'Bearer {store_access_token}'}
-    json_data['data']['relationships']['flow']['data']['id'] = flow_id
-    response = requests.post(url, headers=headers, json=json_data)
+    field = dict(json_data['data'])
+    field['relationships'] = {'flow': {'data': {'type': 'flow', 'id': flow_id}}}
+    response = _request('POST', url, 'admin', headers=headers,
+                        json={'data': field})
+    response.raise_for_status()
+
+
+def update_field(store_access_token: str, field_id: str,
+                 attributes: dict) -> None:
+    url = f'https://api.moltin.com/v2/fields/{field_id}'
+    headers = {'Authorization': f'Bearer {store_access_token}'}
+    json_data = {'data': {'type': 'field', 'id': field_id, **attributes}}
+    response = _request('PUT', url, 'admin', headers=headers, json=json_data)
     response.raise_for_status()
 
 
@@ -224,7 +442,7 @@ def create_entries_for_flow(store_access_token: str,
                 'longitude': float(data[1]),
             },
         }
-    response = requests.post(url, headers=headers, json=json_data)
+    response = _request('POST', url, 'flows', headers=headers, json=json_data)
     response.raise_for_status()
     return response.json()['data']['id']
 
@@ -232,14 +450,18 @@ def create_entries_for_flow(store_access_token: str,
 def get_pizzeria_list(store_access_token: str) -> dict:
     url = 'https://api.moltin.com/v2/flows/pizzeria/entries?page[limit]=200'
     headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-    return response.json()
+
+    def fetch():
+        response = _request('GET', url, 'flows', headers=headers)
+        response.raise_for_status()
+        return response.json()
+
+    return _with_fallback(store_access_token, 'pizzerias', fetch)
 
 
 def get_entry_from_flow(store_access_token: str, flow: str, entry_id: str) -> dict:
     url = f'https://api.moltin.com/v2/flows/{flow}/entries/{entry_id}'
     headers = {'Authorization': f'Bearer {store_access_token}'}
-    response = requests.get(url, headers=headers)
+    response = _request('GET', url, 'flows', hedge=True, headers=headers)
     response.raise_for_status()
     return response.json()
@@ -0,0 +1,148 @@
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+_current = threading.local()
+
+# the innermost frame matching one of the rules decides where time went
+SPAN_RULES = (
+    ('redis',
+     lambda frame: f'{os.sep}redis{os.sep}' in frame.f_code.co_filename),
+    ('telegram',
+     lambda frame: f'{os.sep}telegram{os.sep}' in frame.f_code.co_filename),
+    ('geocoder',
+     lambda frame: frame.f_code.co_name == 'fetch_coordinates'),
+    ('moltin',
+     lambda frame: frame.f_code.co_filename.endswith('moltin_api.py')),
+)
+
+
+class UpdateCapture:
+    def __init__(self) -> None:
+        self.chat_state = None
+        self.handler = None
+        self.stacks = Counter()
+        self.spans = Counter()
+        self.samples = 0
+
+
+def annotate_update(**kwargs) -> None:
+    '''Attaches chat state and handler name to the profiled update.'''
+    capture = getattr(_current, 'capture', None)
+    if capture:
+        for key, value in kwargs.items():
+            setattr(capture, key, value)
+
+
+class UpdateProfiler:
+    '''Samples the stack of threads processing updates.
+
+    A background thread takes a stack sample of every profiled update every
+    `interval` seconds. Captures of a `sample_rate` fraction of updates and of
+    every update slower than `slow_threshold` seconds are written to
+    `directory`, only the newest `max_files` captures are kept.
+    '''
+
+    def __init__(self, directory: str, sample_rate: float = 0.01,
+                 slow_threshold: float = 2, max_files: int = 200,
+                 interval: float = 0.005) -> None:
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_files = max_files
+        self.interval = interval
+        self._active = {}
+        self._lock = threading.Lock()
+        self._has_active = threading.Event()
+        os.makedirs(directory, exist_ok=True)
+        threading.Thread(target=self._sample_forever, daemon=True,
+                         name='update_profiler').start()
+
+    def _sample_forever(self) -> None:
+        while True:
+            self._has_active.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id, capture in self._active.items():
+                    frame = frames.get(thread_id)
+                    if frame:
+                        self._take_sample(capture, frame)
+
+    def _take_sample(self, capture: UpdateCapture, frame) -> None:
+        span = None
+        stack = []
+        while frame:
+            code = frame.f_code
+            stack.append(f'{os.path.basename(code.co_filename)}:'
+                         f'{code.co_name}:{frame.f_lineno}')
+            if span is None:
+                for name, matches in SPAN_RULES:
+                    if matches(frame):
+                        span = name
+                        break
+            frame = frame.f_back
+        capture.stacks[';'.join(reversed(stack))] += 1
+        capture.spans[span or 'bot'] += 1
+        capture.samples += 1
+
+    def wrap(self, handler):
+        @wraps(handler)
+        def profiled_handler(*args, **kwargs):
+            capture = UpdateCapture()
+            thread_id = threading.get_ident()
+            _current.capture = capture
+            with self._lock:
+                self._active[thread_id] = capture
+                self._has_active.set()
+            started_at = time.monotonic()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                duration = time.monotonic() - started_at
+                with self._lock:
+                    del self._active[thread_id]
+                    if not self._active:
+                        self._has_active.clear()
+                _current.capture = None
+                is_slow = duration >= self.slow_threshold
+                if is_slow or random.random() < self.sample_rate:
+                    try:
+                        self._save(capture, duration, is_slow)
+                    except OSError as err:
+                        logger.warning(f'Не удалось сохранить профиль\n{err}\n')
+        return profiled_handler
+
+    def _save(self, capture: UpdateCapture, duration: float,
+              is_slow: bool) -> None:
+        samples = capture.samples or 1
+        report = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'duration': round(duration, 4),
+            'slow': is_slow,
+            'chat_state': capture.chat_state,
+            'handler': capture.handler,
+            'samples': capture.samples,
+            'spans': {
+                name: round(duration * count / samples, 4)
+                for name, count in capture.spans.most_common()
+            },
+            'stacks': dict(capture.stacks.most_common()),
+        }
+        filename = f'{time.time_ns()}_{capture.handler or "update"}.json'
+        with open(os.path.join(self.directory, filename), 'w') as f:
+            json.dump(report, f, ensure_ascii=False)
+        self._rotate()
+
+    def _rotate(self) -> None:
+        filenames = sorted(os.listdir(self.directory))
+        for filename in filenames[:-self.max_files]:
+            os.remove(os.path.join(self.directory, filename))
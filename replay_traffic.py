@@ -0,0 +1,273 @@
+import argparse
+import io
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+import redis
+import requests
+from environs import Env
+from telegram import Update
+from telegram.ext import CallbackContext, Dispatcher
+
+import bot
+import moltin_api
+from traffic import get_request_key, load_traffic
+
+ID_PATTERN = re.compile(r'/(-?\d+|[0-9a-f]{8}-[0-9a-f-]{27})(?=/|$)')
+
+
+def get_path_template(method: str, url: str) -> str:
+    '''Groups requests to different products and carts by the endpoint.'''
+    parts = urlsplit(url)
+    return f'{method} {parts.hostname}{ID_PATTERN.sub("/:id", parts.path)}'
+
+
+def get_percentile(values: list[float], percent: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def summarize(durations: list[float]) -> dict:
+    return {
+        'count': len(durations),
+        'p50_ms': round(get_percentile(durations, 50) * 1000, 1),
+        'p95_ms': round(get_percentile(durations, 95) * 1000, 1),
+        'total_ms': round(sum(durations) * 1000, 1),
+    }
+
+
+class StandInSession:
+    '''Answers requests with the responses recorded for the same key.
+
+    Responses of one key are returned in the recorded order, the last one is
+    repeated when the recording runs out. Unknown requests get `404`.
+    '''
+
+    def __init__(self, calls: list[dict], bodies: dict, counter: Counter,
+                 upstream_latency: bool = True) -> None:
+        self._responses = defaultdict(list)
+        for call in calls:
+            if 'key' in call:
+                self._responses[call['key']].append(call)
+        self._bodies = bodies
+        self._served = Counter()
+        self._lock = threading.Lock()
+        self.calls = counter
+        self.missing = Counter()
+        self.upstream_latency = upstream_latency
+
+    def request(self, method, url, *args, **kwargs):
+        key = get_request_key(method, url)
+        self.calls[get_path_template(method, url)] += 1
+        with self._lock:
+            responses = self._responses.get(key)
+            if not responses:
+                self.missing[key] += 1
+                return self._make_response(url, 404, None)
+            call = responses[min(self._served[key], len(responses) - 1)]
+            self._served[key] += 1
+        if self.upstream_latency:
+            time.sleep(call['elapsed'])
+        if 'error' in call:
+            raise getattr(requests.exceptions, call['error'],
+                          requests.exceptions.ConnectionError)(url)
+        return self._make_response(url, call['status'],
+                                   self._bodies.get(call['body']))
+
+    @staticmethod
+    def _make_response(url: str, status: int, body) -> requests.Response:
+        response = requests.Response()
+        response.url = url
+        response.status_code = status
+        response._content = json.dumps(body).encode('utf-8') \
+            if body is not None else b''
+        response.raw = io.BytesIO(response._content)
+        response.headers['Content-Type'] = 'application/json'
+        return response
+
+
+class StandInBot:
+    '''Accepts any Telegram method and counts the calls.'''
+
+    username = 'stand_in_bot'
+    defaults = None
+
+    def __init__(self, counter: Counter, prefix: str = 'telegram') -> None:
+        self.calls = counter
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self.calls[f'{self._prefix} {name}'] += 1
+            return SimpleNamespace(
+                message_id=1,
+                photo=[SimpleNamespace(file_id='stand-in')],
+            )
+        return call
+
+
+class WarningCounter(logging.Handler):
+    def __init__(self) -> None:
+        super().__init__(level=logging.WARNING)
+        self.count = 0
+
+    def emit(self, record) -> None:
+        self.count += 1
+
+
+def get_handler_label(record: dict) -> str:
+    message = record['update'].get('message') or {}
+    if message.get('text', '').startswith('/start'):
+        return 'START'
+    return record['state'] or 'START'
+
+
+def replay(path: str, _database, speed: float, upstream_latency: bool,
+           store_name: str | None) -> dict:
+    updates, background_calls, bodies = load_traffic(path)
+    if store_name is not None:
+        updates = [record for record in updates
+                   if record['store'] == store_name]
+    updates.sort(key=lambda record: record['t'])
+    recorded_calls = [call for record in updates for call in record['calls']]
+    recorded_calls += [record['call'] for record in background_calls]
+
+    calls = Counter()
+    session = StandInSession(recorded_calls, bodies, calls, upstream_latency)
+    moltin_api.http_session.request = session.request
+    stand_in_bot = StandInBot(calls)
+    dispatcher = Dispatcher(stand_in_bot, None, workers=1,
+                            job_queue=StandInBot(Counter(), 'job_queue'))
+    env = Env()
+    env.read_env()
+    os.environ.setdefault('YANDEX_GEOCODER_APIKEY', 'stand-in')
+    settings = bot.read_settings(env)
+    store = {
+        'name': store_name or '',
+        'client_id': 'stand-in',
+        'client_secret': 'stand-in',
+        'token_lifetime': 3600,
+        'products_per_page': env.int('PRODUCTS_PER_PAGE', 6),
+        'payment_token': 'stand-in',
+    }
+    bot.fill_bot_data(dispatcher.bot_data, store, settings, _database)
+    # the bot keeps its token in Redis, so captures rarely hold an oauth call
+    _database.set('store_access_token', 'stand-in')
+    warnings = WarningCounter()
+    bot.logger.addHandler(warnings)
+    bot.refresh_catalog_index(SimpleNamespace(bot_data=dispatcher.bot_data))
+
+    durations = defaultdict(list)
+    started_at = time.monotonic()
+    for record in updates:
+        if speed:
+            delay = (record['t'] - updates[0]['t']) / speed \
+                - (time.monotonic() - started_at)
+            if delay > 0:
+                time.sleep(delay)
+        update = Update.de_json(record['update'], stand_in_bot)
+        if record['state'] and update.effective_chat:
+            _database.set(update.effective_chat.id, record['state'])
+        context = CallbackContext.from_update(update, dispatcher)
+        handled_at = time.perf_counter()
+        bot.handle_users_reply(update, context)
+        durations[get_handler_label(record)].append(
+            time.perf_counter() - handled_at)
+    settings['executor'].shutdown(wait=True)
+    duration = time.monotonic() - started_at
+    bot.logger.removeHandler(warnings)
+
+    all_durations = [value for values in durations.values()
+                     for value in values]
+    return {
+        'updates': len(all_durations),
+        'duration_s': round(duration, 2),
+        'latency': summarize(all_durations) if all_durations else {},
+        'handlers': {label: summarize(values)
+                     for label, values in sorted(durations.items())},
+        'calls': dict(sorted(calls.items())),
+        'missing_responses': dict(session.missing),
+        'errors': warnings.count,
+    }
+
+
+def print_comparison(old_report: dict, new_report: dict) -> None:
+    def format_change(old, new) -> str:
+        if not old:
+            return f'{old} -> {new}'
+        return f'{old} -> {new} ({(new - old) / old * 100:+.0f}%)'
+
+    for key in ('p50_ms', 'p95_ms', 'total_ms'):
+        print(f'{key}: ' + format_change(old_report['latency'].get(key, 0),
+                                         new_report['latency'].get(key, 0)))
+    print('\nОбработчики:')
+    for label in sorted(old_report['handlers'].keys()
+                        | new_report['handlers'].keys()):
+        old = old_report['handlers'].get(label, {})
+        new = new_report['handlers'].get(label, {})
+        print(f'{label}: p95 ' + format_change(old.get('p95_ms', 0),
+                                               new.get('p95_ms', 0)))
+    print('\nВызовы:')
+    for call in sorted(old_report['calls'].keys()
+                       | new_report['calls'].keys()):
+        old = old_report['calls'].get(call, 0)
+        new = new_report['calls'].get(call, 0)
+        if old != new:
+            print(f'{call}: ' + format_change(old, new))
+    print('\nОшибки: ' + format_change(old_report['errors'],
+                                       new_report['errors']))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Воспроизведение записанных сообщений без магазина и '
+                    'Telegram'
+    )
+    parser.add_argument('path', nargs='?', default='traffic.jsonl',
+                        help='Файл, записанный с CAPTURE_TRAFFIC=True')
+    parser.add_argument('--speed', default=0, type=float,
+                        help='Ускорение относительно записи, 0 — без пауз')
+    parser.add_argument('--no_upstream_latency', action='store_true',
+                        help='Отвечать без записанных задержек магазина')
+    parser.add_argument('--store', default=None, type=str,
+                        help='Название магазина из STORES_CONFIG')
+    parser.add_argument('--redis_url', default=None, type=str,
+                        help='Redis для воспроизведения, по умолчанию '
+                             'fakeredis')
+    parser.add_argument('--output', default=None, type=str,
+                        help='Куда сохранить отчёт в json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='Сравнить два сохранённых отчёта')
+    args = parser.parse_args()
+
+    if args.compare:
+        reports = []
+        for report_path in args.compare:
+            with open(report_path, 'r', encoding='utf-8') as f:
+                reports.append(json.load(f))
+        print_comparison(*reports)
+        return
+
+    if args.redis_url:
+        _database = redis.Redis.from_url(args.redis_url)
+    else:
+        import fakeredis
+        _database = fakeredis.FakeRedis()
+    report = replay(args.path, _database, args.speed,
+                    not args.no_upstream_latency, args.store)
+    raw_report = json.dumps(report, ensure_ascii=False, indent=4)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(raw_report)
+    print(raw_report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ThreadPoolExecutor,
+                                wait)
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpenError(requests.exceptions.RequestException):
+    '''Raised instead of a request while the circuit breaker is open.'''
+
+
+class CircuitBreaker:
+    '''Stops calling an upstream after a series of failures.
+
+    After `failure_threshold` consecutive failures the breaker opens and every
+    call fails fast with CircuitOpenError. Once `recovery_timeout` seconds
+    pass, a single trial call is let through: success closes the breaker,
+    failure opens it again.
+    '''
+
+    def __init__(self, name: str, failure_threshold: int = 5,
+                 recovery_timeout: float = 30) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_progress = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._opened_at is not None
+
+    def _before_call(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            recovery_passed = \
+                time.monotonic() - self._opened_at >= self.recovery_timeout
+            if recovery_passed and not self._trial_in_progress:
+                self._trial_in_progress = True
+                return
+        raise CircuitOpenError(f'Circuit breaker {self.name} is open')
+
+    def _record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                logger.info(f'Circuit breaker {self.name} closed')
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_progress = False
+
+    def _record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            self._trial_in_progress = False
+            if self._opened_at is not None \
+                    or self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    logger.warning(f'Circuit breaker {self.name} opened')
+                self._opened_at = time.monotonic()
+
+    def call(self, func, *args, **kwargs):
+        '''Calls `func` through the breaker.
+
+        Transport errors and responses with a 5xx status count as failures,
+        any other outcome counts as success.
+        '''
+        self._before_call()
+        try:
+            result = func(*args, **kwargs)
+        except requests.exceptions.RequestException:
+            self._record_failure()
+            raise
+        except Exception:
+            self._record_success()
+            raise
+        if isinstance(result, requests.Response) and result.status_code >= 500:
+            self._record_failure()
+        else:
+            self._record_success()
+        return result
+
+
+class LatencyTracker:
+    '''Keeps recent latencies per endpoint to estimate percentiles.'''
+
+    def __init__(self, window: int = 200, min_samples: int = 20) -> None:
+        self.window = window
+        self.min_samples = min_samples
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint: str, seconds: float) -> None:
+        with self._lock:
+            samples = self._samples.setdefault(endpoint,
+                                               deque(maxlen=self.window))
+            samples.append(seconds)
+
+    def percentile(self, endpoint: str, percent: float) -> float | None:
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if len(samples) < self.min_samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percent / 100))
+        return samples[index]
+
+
+HEDGE_WORKERS = 8
+_hedge_executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS,
+                                     thread_name_prefix='hedged_request')
+_hedge_slots = threading.BoundedSemaphore(HEDGE_WORKERS)
+
+
+def _submit_to_free_worker(func, *args, **kwargs) -> Future | None:
+    '''Starts `func` in the pool only if a worker is free right now.'''
+    if not _hedge_slots.acquire(blocking=False):
+        return None
+    future = _hedge_executor.submit(func, *args, **kwargs)
+    future.add_done_callback(lambda _: _hedge_slots.release())
+    return future
+
+
+def hedged_call(func, delay: float, *args, **kwargs):
+    '''Calls `func` and fires a second attempt if the first one is slow.
+
+    The second attempt starts after `delay` seconds, the result of whichever
+    attempt succeeds first is returned. Attempts never wait in the queue of
+    the pool: while every worker is busy the call is made on the caller's
+    thread and is not hedged. Use only for idempotent requests.
+    '''
+    first = _submit_to_free_worker(func, *args, **kwargs)
+    if first is None:
+        return func(*args, **kwargs)
+    done, _ = wait([first], timeout=delay)
+    if done:
+        return first.result()
+    second = _submit_to_free_worker(func, *args, **kwargs)
+    if second is None:
+        return first.result()
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                for loser in pending:
+                    loser.cancel()
+                return future.result()
+            error = future.exception()
+    raise error
+
+
+class SingleFlight:
+    '''Lets concurrent identical calls share the result of one of them.'''
+
+    def __init__(self) -> None:
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def call(self, key, func, *args, **kwargs):
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._calls[key] = future
+        if not is_leader:
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as err:
+            future.set_exception(err)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
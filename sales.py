@@ -0,0 +1,55 @@
+import json
+from datetime import datetime
+
+SALES_STREAM = 'sales_stream'
+SALES_STREAM_MAXLEN = 100000
+PRODUCT_SALES = 'sales_by_product'
+PIZZERIA_ORDERS = 'orders_by_pizzeria'
+PIZZERIA_REVENUE = 'revenue_by_pizzeria'
+HOURLY_ORDERS = 'orders_by_hour'
+
+
+def record_order(_database, snapshot: dict, pizzeria_id: str,
+                 ordered_at: datetime) -> None:
+    '''Appends the order to the stream and updates the sales counters.
+
+    Counters are updated in the same transaction as the stream entry, so the
+    history never has to be rescanned.
+    '''
+    with _database.pipeline() as pipe:
+        pipe.xadd(SALES_STREAM, {
+            'items': json.dumps(snapshot['items'], separators=(',', ':')),
+            'total': snapshot['total'],
+            'pizzeria': pizzeria_id,
+        }, maxlen=SALES_STREAM_MAXLEN, approximate=True)
+        for product_id, quantity, _ in snapshot['items']:
+            pipe.hincrby(PRODUCT_SALES, product_id, quantity)
+        pipe.hincrby(PIZZERIA_ORDERS, pizzeria_id, 1)
+        pipe.hincrby(PIZZERIA_REVENUE, pizzeria_id, snapshot['total'])
+        pipe.hincrby(HOURLY_ORDERS, f'{ordered_at.hour:02}', 1)
+        pipe.execute()
+
+
+def decode_counters(raw_counters: dict) -> dict:
+    return {key.decode('utf-8'): int(value)
+            for key, value in raw_counters.items()}
+
+
+def get_product_sales(_database) -> dict:
+    return decode_counters(_database.hgetall(PRODUCT_SALES))
+
+
+def sort_by_popularity(products: dict, product_sales: dict) -> dict:
+    '''Puts the best selling products first, keeping the order of the rest.'''
+    return dict(sorted(products.items(),
+                       key=lambda item: -product_sales.get(item[0], 0)))
+
+
+def get_sales_report(_database) -> dict:
+    return {
+        'products': get_product_sales(_database),
+        'pizzeria_orders': decode_counters(_database.hgetall(PIZZERIA_ORDERS)),
+        'pizzeria_revenue':
+            decode_counters(_database.hgetall(PIZZERIA_REVENUE)),
+        'hours': decode_counters(_database.hgetall(HOURLY_ORDERS)),
+    }
@@ -0,0 +1,76 @@
+import argparse
+import logging
+
+import redis
+import requests
+from environs import Env
+
+from moltin_api import get_products, get_pizzeria_list
+from sales import get_sales_report
+from tenants import NamespacedRedis
+
+logger = logging.getLogger(__name__)
+
+
+def get_names(store_access_token: str | None) -> tuple[dict, dict]:
+    '''Returns names of products and pizzerias, empty if the store is down.'''
+    if not store_access_token:
+        return {}, {}
+    try:
+        product_names = {product['id']: product['attributes']['name']
+                         for product in get_products(store_access_token)}
+        pizzeria_names = {pizzeria['id']: pizzeria['alias']
+                          for pizzeria
+                          in get_pizzeria_list(store_access_token)['data']}
+    except requests.exceptions.RequestException as error:
+        logger.warning(error)
+        return {}, {}
+    return product_names, pizzeria_names
+
+
+def main():
+    env = Env()
+    env.read_env()
+    database_password = env.str("REDIS_PASSWORD")
+    database_host = env.str("REDIS_HOST")
+    database_port = env.int("REDIS_PORT")
+    parser = argparse.ArgumentParser(
+        description='Отчёт о продажах пиццерии'
+    )
+    parser.add_argument('--store', default='', type=str,
+                        help='Название магазина из STORES_CONFIG')
+    parser.add_argument('--top', default=10, type=int,
+                        help='Количество самых продаваемых пицц в отчёте')
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        level=logging.INFO
+    )
+    _database = redis.Redis(host=database_host, port=database_port,
+                            password=database_password)
+    if args.store:
+        _database = NamespacedRedis(_database, args.store)
+    report = get_sales_report(_database)
+    store_access_token = _database.get('store_access_token')
+    product_names, pizzeria_names = get_names(
+        store_access_token and store_access_token.decode('utf-8'))
+
+    print('Всего заказов:', sum(report['pizzeria_orders'].values()))
+    print('\nСамые продаваемые пиццы:')
+    best_sellers = sorted(report['products'].items(),
+                          key=lambda item: item[1], reverse=True)
+    for product_id, quantity in best_sellers[:args.top]:
+        print(f'{product_names.get(product_id, product_id)}: {quantity} шт.')
+    print('\nПиццерии:')
+    for pizzeria_id, orders in sorted(report['pizzeria_orders'].items(),
+                                      key=lambda item: item[1], reverse=True):
+        revenue = report['pizzeria_revenue'].get(pizzeria_id, 0) / 100
+        print(f'{pizzeria_names.get(pizzeria_id, pizzeria_id)}: '
+              f'{orders} заказов на {revenue:.2f} РУБ')
+    print('\nЗаказы по часам:')
+    for hour, orders in sorted(report['hours'].items()):
+        print(f'{hour}:00 — {orders}')
+
+
+if __name__ == '__main__':
+    main()
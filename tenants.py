@@ -0,0 +1,68 @@
+import json
+
+# commands whose first argument is a key
+KEY_COMMANDS = {'get', 'set', 'setex', 'expire', 'incr', 'hget', 'hset',
+                'hincrby', 'hgetall', 'hvals', 'lpush', 'rpush', 'lrange',
+                'sadd', 'smembers', 'xadd'}
+# commands where every positional argument is a key
+MULTI_KEY_COMMANDS = {'delete'}
+# commands and attributes that do not take keys
+KEYLESS_COMMANDS = {'execute', 'reset', 'ping', 'close'}
+
+
+class NamespacedRedis:
+    '''Prefixes keys of a shared Redis client with the store name.
+
+    All stores of the process use one client and one connection pool, while
+    chat states, carts and tokens of different stores never collide. Other
+    commands are refused, so a new command cannot write a shared key
+    unnoticed: add it to one of the lists above first.
+    '''
+
+    def __init__(self, client, namespace: str) -> None:
+        self._client = client
+        self.namespace = namespace
+
+    def _key(self, key) -> str:
+        return f'{self.namespace}:{key}'
+
+    def __getattr__(self, name):
+        if name in KEY_COMMANDS:
+            command = getattr(self._client, name)
+            return lambda key, *args, **kwargs: \
+                command(self._key(key), *args, **kwargs)
+        if name in MULTI_KEY_COMMANDS:
+            command = getattr(self._client, name)
+            return lambda *keys, **kwargs: \
+                command(*map(self._key, keys), **kwargs)
+        if name in KEYLESS_COMMANDS:
+            return getattr(self._client, name)
+        raise AttributeError(
+            f'Команда {name} не поддерживает магазины, добавьте её в '
+            'KEY_COMMANDS, MULTI_KEY_COMMANDS или KEYLESS_COMMANDS'
+        )
+
+    def pipeline(self, *args, **kwargs) -> 'NamespacedRedis':
+        return NamespacedRedis(self._client.pipeline(*args, **kwargs),
+                               self.namespace)
+
+    def __enter__(self) -> 'NamespacedRedis':
+        self._client.__enter__()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._client.__exit__(*exc_info)
+
+
+def load_stores(path: str) -> list[dict]:
+    '''Reads the list of stores served by one process.
+
+    Every store needs `name`, `tg_token`, `payment_token`, `client_id` and
+    `client_secret`, `token_lifetime` and `products_per_page` are optional.
+    '''
+    with open(path, 'r') as f:
+        stores = json.load(f)
+    names = [store['name'] for store in stores]
+    if len(set(names)) != len(names):
+        raise ValueError('Названия магазинов в конфиге должны различаться')
+    return stores
@@ -0,0 +1,271 @@
+import hashlib
+import json
+import re
+import secrets
+import threading
+import time
+from functools import wraps
+from urllib.parse import urlsplit
+
+import requests
+
+GEOCODER_HOST = 'geocode-maps.yandex.ru'
+CART_ID_PATTERN = re.compile(r'/carts/(-?\d+)')
+PRIVATE_FIELDS = {'last_name', 'username', 'title', 'phone_number',
+                  'language_code', 'forward_sender_name', 'author_signature',
+                  'forward_signature', 'bio', 'description'}
+FREE_TEXT_FIELDS = {'text', 'caption'}
+CHAT_TYPES = {'private', 'group', 'supergroup', 'channel'}
+COORDINATE_PRECISION = 3
+
+_current = threading.local()
+
+
+def hash_id(value, salt: str) -> int:
+    digest = hashlib.sha256(f'{salt}{value}'.encode('utf-8')).hexdigest()
+    return int(digest[:12], 16)
+
+
+def get_request_key(method: str, url: str, salt: str | None = None) -> str:
+    '''Identifies a request by its method and url without private data.
+
+    Cart ids (chat ids) are hashed when `salt` is given, the geocoder query
+    holding the address and the api key is dropped.
+    '''
+    parts = urlsplit(url)
+    path = parts.path
+    if salt is not None:
+        path = CART_ID_PATTERN.sub(
+            lambda match: f'/carts/{hash_id(match.group(1), salt)}', path)
+    key = f'{method} {parts.scheme}://{parts.netloc}{path}'
+    if parts.query and parts.hostname != GEOCODER_HOST:
+        key += f'?{parts.query}'
+    return key
+
+
+def coarsen_coordinates(value):
+    if isinstance(value, dict):
+        return {
+            key: round(item, COORDINATE_PRECISION)
+            if key in ('latitude', 'longitude') and isinstance(item, float)
+            else coarsen_coordinates(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [coarsen_coordinates(item) for item in value]
+    return value
+
+
+def is_telegram_user_or_chat(value: dict) -> bool:
+    return 'is_bot' in value or value.get('type') in CHAT_TYPES
+
+
+def anonymize_update(value, salt: str):
+    '''Hashes chat and user ids, drops names and free text of the update.
+
+    Every user and chat object is hashed, including forwarded senders and
+    new members, not only the sender and the chat of the message.
+    '''
+    if isinstance(value, list):
+        return [anonymize_update(item, salt) for item in value]
+    if not isinstance(value, dict):
+        return value
+    anonymized = {}
+    for key, item in value.items():
+        if key in PRIVATE_FIELDS:
+            continue
+        if key in FREE_TEXT_FIELDS and not item.startswith('/'):
+            anonymized[key] = key
+        elif key == 'first_name':
+            # required by telegram.User
+            anonymized[key] = 'user'
+        elif key == 'user_id':
+            anonymized[key] = hash_id(item, salt)
+        else:
+            anonymized[key] = anonymize_update(item, salt)
+    if 'id' in value and is_telegram_user_or_chat(value):
+        anonymized['id'] = hash_id(value['id'], salt)
+    return coarsen_coordinates(anonymized)
+
+
+def hash_deliverymen(value, salt: str):
+    '''Hashes chat ids of couriers stored in pizzeria entries.'''
+    if isinstance(value, list):
+        return [hash_deliverymen(item, salt) for item in value]
+    if not isinstance(value, dict):
+        return value
+    return {
+        key: ','.join(str(hash_id(chat_id.strip(), salt))
+                      for chat_id in str(item).split(','))
+        if key == 'deliveryman_id' and item
+        else hash_deliverymen(item, salt)
+        for key, item in value.items()
+    }
+
+
+def anonymize_response(url: str, body, salt: str):
+    hostname = urlsplit(url).hostname
+    if url.endswith('/oauth/access_token'):
+        return {'access_token': 'stand-in'}
+    if hostname == GEOCODER_HOST:
+        found_places = body['response']['GeoObjectCollection']['featureMember']
+        places = []
+        for place in found_places[:1]:
+            lon, lat = place['GeoObject']['Point']['pos'].split(' ')
+            pos = f'{round(float(lon), COORDINATE_PRECISION)} ' \
+                  f'{round(float(lat), COORDINATE_PRECISION)}'
+            places.append({'GeoObject': {'Point': {'pos': pos}}})
+        return {'response': {'GeoObjectCollection': {'featureMember': places}}}
+    return coarsen_coordinates(hash_deliverymen(body, salt))
+
+
+class TrafficRecorder:
+    '''Writes anonymized updates and the upstream calls they triggered.
+
+    The log is a JSON-lines file with three kinds of records: `update`
+    records with the calls made while handling the update, `call` records for
+    requests made outside of handlers (prefetch, retries) and `body` records
+    holding every distinct response body once.
+    '''
+
+    def __init__(self, path: str, salt: str | None = None) -> None:
+        self.salt = salt or secrets.token_hex(16)
+        self._file = open(path, 'a', encoding='utf-8')
+        self._written_bodies = set()
+        self._lock = threading.Lock()
+
+    def _write(self, record: dict) -> None:
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':'))
+        with self._lock:
+            self._file.write(line + '\n')
+            self._file.flush()
+
+    def _write_body(self, body) -> str:
+        raw_body = json.dumps(body, ensure_ascii=False, sort_keys=True,
+                              separators=(',', ':'))
+        body_hash = hashlib.sha1(raw_body.encode('utf-8')).hexdigest()[:16]
+        with self._lock:
+            is_new = body_hash not in self._written_bodies
+            self._written_bodies.add(body_hash)
+        if is_new:
+            self._write({'body': body_hash, 'data': body})
+        return body_hash
+
+    def _add_call(self, call: dict) -> None:
+        calls = getattr(_current, 'calls', None)
+        if calls is not None:
+            calls.append(call)
+        elif call['kind'] != 'redis':
+            self._write({'t': time.time(), 'call': call})
+
+    def record_session(self, session: requests.Session) -> None:
+        '''Records every request sent through the session.'''
+        send = session.request
+
+        def recorded_request(method, url, *args, **kwargs):
+            key = get_request_key(method, url, self.salt)
+            kind = 'geocoder' if urlsplit(url).hostname == GEOCODER_HOST \
+                else 'moltin'
+            started_at = time.monotonic()
+            try:
+                response = send(method, url, *args, **kwargs)
+            except requests.exceptions.RequestException as err:
+                self._add_call({'kind': kind, 'key': key,
+                                'error': type(err).__name__,
+                                'elapsed': time.monotonic() - started_at})
+                raise
+            elapsed = time.monotonic() - started_at
+            body = None
+            if not kwargs.get('stream'):
+                try:
+                    body = anonymize_response(url, response.json(),
+                                              self.salt)
+                except (ValueError, KeyError):
+                    body = None
+            self._add_call({'kind': kind, 'key': key,
+                            'status': response.status_code,
+                            'body': self._write_body(body),
+                            'elapsed': elapsed})
+            return response
+
+        session.request = recorded_request
+
+    def record_redis(self, _database) -> 'RecordingRedis':
+        return RecordingRedis(_database, self)
+
+    def wrap(self, handler):
+        @wraps(handler)
+        def recorded_handler(update, context):
+            _database = context.bot_data['_database']
+            chat_state = None
+            if update.effective_chat:
+                chat_state = _database.get(update.effective_chat.id)
+            _current.calls = []
+            started_at = time.monotonic()
+            try:
+                return handler(update, context)
+            finally:
+                duration = time.monotonic() - started_at
+                calls = _current.calls
+                _current.calls = None
+                self._write({
+                    't': time.time(),
+                    'store': context.bot_data.get('store_name', ''),
+                    'state': chat_state and chat_state.decode('utf-8'),
+                    'update': anonymize_update(update.to_dict(), self.salt),
+                    'duration': duration,
+                    'calls': calls,
+                })
+        return recorded_handler
+
+
+class RecordingRedis:
+    '''Times Redis commands sent while an update is being handled.'''
+
+    def __init__(self, client, recorder: TrafficRecorder,
+                 is_pipeline: bool = False) -> None:
+        self._client = client
+        self._recorder = recorder
+        self._is_pipeline = is_pipeline
+
+    def __getattr__(self, name):
+        command = getattr(self._client, name)
+        if not callable(command) or (self._is_pipeline and name != 'execute'):
+            return command
+
+        def recorded_command(*args, **kwargs):
+            started_at = time.monotonic()
+            result = command(*args, **kwargs)
+            self._recorder._add_call({
+                'kind': 'redis',
+                'command': 'pipeline' if self._is_pipeline else name,
+                'elapsed': time.monotonic() - started_at,
+            })
+            return result
+        return recorded_command
+
+    def pipeline(self, *args, **kwargs) -> 'RecordingRedis':
+        return RecordingRedis(self._client.pipeline(*args, **kwargs),
+                              self._recorder, is_pipeline=True)
+
+    def __enter__(self) -> 'RecordingRedis':
+        self._client.__enter__()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._client.__exit__(*exc_info)
+
+
+def load_traffic(path: str) -> tuple[list, list, dict]:
+    '''Reads updates, calls made outside handlers and response bodies.'''
+    updates, calls, bodies = [], [], {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            record = json.loads(line)
+            if 'body' in record and 'data' in record:
+                bodies[record['body']] = record['data']
+            elif 'call' in record:
+                calls.append(record)
+            else:
+                updates.append(record)
+    return updates, calls, bodies